@@ -17,14 +17,29 @@
 # along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
 
 import minqlbot
+import plugins.aliasindex as aliasindex
+import plugins.events as events
 
 class alias(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        self.add_hook("unload", self.handle_unload)
+        events.subscribe(self, events.ALIAS_CHANGED, self.handle_alias_changed)
+        for other_name, kept, rejected in aliasindex.get_index().conflicts:
+            self.debug("{} is registered as an alias of both {} and {}. Only {} is used."
+                .format(other_name, kept, rejected, kept))
         self.add_command(("add_alias", "addalias", "set_alias", "setalias"), self.cmd_add_alias, 3, usage="<full_name> <full_alias>")
         self.add_command(("remove_alias", "remalias"), self.cmd_remove_alias, 3, usage="<full_name> <full_alias>")
         self.add_command(("get_alias", "getalias", "check_alias", "checkalias"), self.cmd_get_alias, 3, usage="<full_name>")
         
+    def handle_unload(self):
+        events.unsubscribe(self)
+
+    def handle_alias_changed(self, names):
+        # Our own changes are already in the index, but a raw write could be anything.
+        if names is None:
+            aliasindex.get_index().load()
+
     def cmd_add_alias(self, player, msg, channel):
         if len(msg) < 3:
             return minqlbot.RET_USAGE
@@ -32,18 +47,29 @@ class alias(minqlbot.Plugin):
         real = self.clean_text(msg[1]).lower()
         fake = self.clean_text(msg[2]).lower()
         
+        index = aliasindex.get_index()
+        claimed = index.claimed_by(real, fake)
+        if claimed == fake:
+            channel.reply("^6{}^7 is already the main account of ^6{}^7.".format(msg[2], msg[1]))
+            return
+        elif claimed:
+            channel.reply("^6{}^7 is already an alias of ^6{}^7. Remove that one first."
+                .format(msg[2], claimed))
+            return
+
         c = self.db_query("SELECT * FROM Players WHERE name=?", real)
         if not c.fetchone():
-            self.db_query("INSERT INTO Players VALUES(?, 0, '', 0, 0)", real)
+            self.db_query("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) VALUES(?, 0, '', 0, 0)", real)
             self.db_commit()
         
         c = self.db_query("SELECT * FROM Aliases WHERE name=? AND other_name=?", real, fake)
         if not c.fetchone():
             self.db_query("INSERT INTO Aliases VALUES(?, ?)", real, fake)
             self.db_commit()
+            index.add(real, fake)
             channel.reply("^6{}^7 will now be treated as ^6{}^7 in the context of balance."
                 .format(msg[2], msg[1]))
-            self.remove_name_from_balance_cache(fake)
+            events.publish(events.ALIAS_CHANGED, (real, fake))
         else:
             channel.reply("^7I already know that.")
     
@@ -57,8 +83,10 @@ class alias(minqlbot.Plugin):
         c = self.db_query("DELETE FROM Aliases WHERE name=? AND other_name=?", real, fake)
         if c.rowcount:
             self.db_commit()
+            # Reloaded rather than just removed, in case another main had a claim on it too.
+            aliasindex.get_index().load()
             channel.reply("^7Alias has been deleted.")
-            self.remove_name_from_balance_cache(fake)
+            events.publish(events.ALIAS_CHANGED, (real, fake))
         else:
             channel.reply("^7There are no aliases matching your arguments.")
 
@@ -68,25 +96,12 @@ class alias(minqlbot.Plugin):
         
         who = self.clean_text(msg[1]).lower()
         
-        c = self.db_query("SELECT other_name FROM Aliases WHERE name=?", who)
-        res = c.fetchmany(10)
-        if res:
-            aliases = ", ".join([row["other_name"] for row in res])
-            channel.reply("^6{}^7 is also known as: ^6{}".format(who, aliases))
+        index = aliasindex.get_index()
+        main = index.resolve(who)
+        others = [name for name in index.names(who) if name != main]
+        if main != who:
+            channel.reply("^6{}^7 is an alias of ^6{}^7.".format(msg[1], main))
+        elif others:
+            channel.reply("^6{}^7 is also known as: ^6{}".format(who, ", ".join(others)))
         else:
-            c = self.db_query("SELECT name FROM Aliases WHERE other_name=?", who)
-            row = c.fetchone()
-            if row:
-                channel.reply("^6{}^7 is an alias of ^6{}^7.".format(msg[1], row["name"]))
-            else:
-                channel.reply("^7Sorry, I don't know of any.")
-
-    def remove_name_from_balance_cache(self, name):
-        if "balance" in self.plugins:
-            self.debug(name)
-            self.debug([key for key in self.plugins["balance"].cache])
-            if name in self.plugins["balance"].cache:
-                with self.plugins["balance"].lock: # Gotta use the lock!
-                    self.debug("Removed {} from balance's rating cache!".format(name))
-                    del self.plugins["balance"].cache[name]
-    
\ No newline at end of file
+            channel.reply("^7Sorry, I don't know of any.")
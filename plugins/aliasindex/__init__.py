@@ -0,0 +1 @@
+from plugins.aliasindex.aliasindex import AliasIndex, get_index
\ No newline at end of file
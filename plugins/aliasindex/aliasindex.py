@@ -0,0 +1,125 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""An in-memory index of the Aliases table that resolves any name to its main account.
+
+Every alias has a single edge to the name it's an alias of, so chains like
+alt -> alt -> main resolve to main. Edges only ever go from an alias to its main and
+a main is never made to point anywhere else, so registering an alias can't merge two
+unrelated accounts. An alias claimed by a second main is rejected, and if the table
+already has one, the first main in sorted order wins and the conflict is kept in
+conflicts. Resolved aliases are cached until the next change. Names that aren't aliases
+resolve to themselves without being cached, so the cache never outgrows the table.
+
+All names are lowercase clean names, like in the database.
+"""
+
+import threading
+
+import plugins.database as database
+
+class AliasIndex():
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        # Keys: alias - Items: the name it's an alias of.
+        self.main_of = {}
+        # Keys: alias - Items: its main account, filled in as aliases are resolved.
+        self.resolved = {}
+        # (alias, kept main, rejected main) for rows claiming an alias that already had one.
+        self.conflicts = []
+
+    def load(self, pairs=None):
+        """(Re)build the index from pairs, or from the database if none are given."""
+        if pairs is None:
+            rows = database.get_executor().query("SELECT name, other_name FROM Aliases").result()
+            pairs = [(row["name"], row["other_name"]) for row in rows]
+        with self.lock:
+            self.main_of = {}
+            self.resolved = {}
+            self.conflicts = []
+            # Sorted, so which main wins a conflict doesn't depend on row order.
+            for name, other_name in sorted(set(pairs)):
+                if not self.add(name, other_name):
+                    self.conflicts.append((other_name, self.main_of.get(other_name), name))
+            self.loaded = True
+
+    def claimed_by(self, name, other_name):
+        """Why other_name can't be made an alias of name, or None if it can. Returns the
+        name it's already an alias of, or other_name itself if it would make a loop.
+
+        """
+        with self.lock:
+            current = self.main_of.get(other_name)
+            if current is not None and current != name:
+                return current
+            if self.resolve(name) == other_name:
+                return other_name
+            return None
+
+    def add(self, name, other_name):
+        """Make other_name an alias of name. Returns False if it's already an alias of
+        something else or it'd make a loop.
+
+        """
+        with self.lock:
+            if name == other_name or self.claimed_by(name, other_name) is not None:
+                return False
+            self.main_of[other_name] = name
+            self.resolved = {}
+            return True
+
+    def remove(self, name, other_name):
+        with self.lock:
+            if self.main_of.get(other_name) == name:
+                del self.main_of[other_name]
+                self.resolved = {}
+
+    def resolve(self, name):
+        """The main account of name, or name itself if it isn't an alias."""
+        with self.lock:
+            if name not in self.main_of:
+                return name
+            if name in self.resolved:
+                return self.resolved[name]
+            main = name
+            seen = set()
+            while main in self.main_of and main not in seen:
+                seen.add(main)
+                main = self.main_of[main]
+            self.resolved[name] = main
+            return main
+
+    def is_alias(self, name):
+        return name in self.main_of
+
+    def names(self, name):
+        """Every name with the same main as name, including the main, sorted."""
+        with self.lock:
+            root = self.resolve(name)
+            return sorted(set(n for n in self.main_of if self.resolve(n) == root) | {root})
+
+_index = AliasIndex()
+
+def get_index():
+    """The shared index, loaded from the database on first use."""
+    if not _index.loaded:
+        with _index.lock:
+            if not _index.loaded:
+                _index.load()
+    return _index
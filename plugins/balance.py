@@ -44,6 +44,13 @@ and whatnot without having to deal with that.
 
 from threading import RLock
 import plugins.qlranks as qlranks
+import plugins.database as database
+import plugins.settings as settings
+import plugins.events as events
+import plugins.playerkeys as playerkeys
+import plugins.roster as roster
+import plugins.scheduler as scheduler
+from plugins.settings import Setting
 import minqlbot
 import random
 import re
@@ -52,9 +59,27 @@ FAILS_ALLOWED = 2
 QLRANKS_GAMETYPES = ("ca", "ffa", "ctf", "duel", "tdm")
 ALPHANUMERICAL = re.compile(r"^[a-zA-Z0-9_]*$", flags=0)
 
+SETTINGS = (
+    Setting("veto_uneven_shuffle", "VetoUnevenShuffleVote", bool, False),
+    Setting("auto_balance", "AutoBalance", bool, False),
+    Setting("use_local_ratings", "UseLocalRatings", bool, False),
+    Setting("use_aliases", "UseAliases", bool, True),
+    Setting("qlranks_url", "QlRanksUrl", str, qlranks.QLRANKS_URL),
+    Setting("floor_rating", "FloorRating", int, 0),
+    Setting("ceiling_rating", "CeilingRating", int, 0),
+    Setting("minimum_rating", "MinimumRating", int, 0),
+    Setting("maximum_rating", "MaximumRating", int, 0),
+    Setting("allow_spectators", "AllowSpectators", bool, True),
+    Setting("minimum_suggestion_difference", "MinimumSuggestionDifference", int, 25),
+    )
+
 class balance(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        settings.register(self, "Balance", SETTINGS)
+        events.subscribe(self, events.RATING_CHANGED, self.uncache)
+        events.subscribe(self, events.ALIAS_CHANGED, self.uncache)
+        self.add_hook("unload", self.handle_unload)
         self.add_hook("vote_called", self.handle_vote_called, priority=minqlbot.PRI_HIGH)
         self.add_hook("vote_ended", self.handle_vote_ended)
         self.add_hook("player_connect", self.handle_player_connect)
@@ -66,6 +91,8 @@ class balance(minqlbot.Plugin):
         self.add_command(("setrating", "setelo"), self.cmd_setrating, 3, usage="<full_name> <rating>")
         self.add_command(("getrating", "getelo", "elo"), self.cmd_getrating, usage="<full_name>")
         self.add_command(("remrating", "remelo"), self.cmd_remrating, 3, usage="<full_name>")
+        self.add_command("importratings", self.cmd_importratings, 5, usage="<file.csv|file.jsonl>")
+        self.add_command("exportratings", self.cmd_exportratings, 5, usage="<file.csv|file.jsonl>")
 
         self.suggested_pair = None
         self.suggested_agree = [False, False]
@@ -81,56 +108,50 @@ class balance(minqlbot.Plugin):
         # How many times we've failed a request in a row so we don't loop forever.
         self.fails = 0
 
+    def handle_unload(self):
+        settings.unregister(self)
+        events.unsubscribe(self)
+        scheduler.cancel("balance.auto_balance")
+
     def handle_vote_called(self, caller, vote, args):
-        config = minqlbot.get_config()
-        if vote == "shuffle" and "Balance" in config:
-            auto_reject = config["Balance"].getboolean("VetoUnevenShuffleVote", fallback=False)
-            if auto_reject:
-                teams = self.teams()
-                if len(teams["red"] + teams["blue"]) % 2 == 1:
+        if vote == "shuffle":
+            if self.settings.veto_uneven_shuffle:
+                if roster.get_roster().count("red", "blue") % 2 == 1:
                     self.vote_no()
                     self.msg("^7Only call shuffle votes when the total number of players is an even number.")
 
     def handle_vote_ended(self, vote, args, vote_count, passed):
-        config = minqlbot.get_config()
-        if "Balance" not in config:
-            return
-
         if passed == True and vote == "shuffle":
-            auto = config["Balance"].getboolean("AutoBalance", fallback=False)
-            if not auto:
+            if not self.settings.auto_balance:
                 return
             else:
-                teams = self.teams()
-                total = len(teams["red"]) + len(teams["blue"])
-                if total % 2 == 0:
-                    self.delay(5, self.average_balance, args=(minqlbot.CHAT_CHANNEL, self.game().short_type))
+                if roster.get_roster().count("red", "blue") % 2 == 0:
+                    scheduler.schedule(5, self.average_balance, args=(minqlbot.CHAT_CHANNEL, self.game().short_type),
+                        key="balance.auto_balance")
                 else:
                     self.msg("^7I can't balance when the total number of players is not an even number.")
 
     def handle_player_connect(self, player):
         gametype = self.game().short_type
-        if not self.is_cached(player.clean_name, gametype):
-            self.fetch_player_ratings([player.clean_name.lower()], None, gametype)
-        self.check_rating_requirements([player.clean_name.lower()], None, gametype)
+        name = playerkeys.key(player)
+        if not self.is_cached(name, gametype):
+            self.fetch_player_ratings([name], None, gametype)
+        self.check_rating_requirements([name], None, gametype)
 
     def handle_team_switch(self, player, old_team, new_team):
         if new_team != "spectator":
             gametype = self.game().short_type
-            self.check_rating_requirements([player.clean_name.lower()], None, gametype)
+            self.check_rating_requirements([playerkeys.key(player)], None, gametype)
 
     def cmd_teams(self, player, msg, channel):
-        teams = self.teams()
-        diff = len(teams["red"]) - len(teams["blue"])
-        if not diff:
+        r = roster.get_roster()
+        if r.count("red") == r.count("blue"):
             self.teams_info(channel, self.game().short_type)
         else:
             channel.reply("^7Both teams should have the same number of players.")
 
     def cmd_balance(self, player, msg, channel):
-        teams = self.teams()
-        total = len(teams["red"]) + len(teams["blue"])
-        if total % 2 == 0:
+        if roster.get_roster().count("red", "blue") % 2 == 0:
             self.average_balance(channel, self.game().short_type)
         else:
             channel.reply("^7I can't balance when the total number of players is not an even number.")
@@ -169,12 +190,11 @@ class balance(minqlbot.Plugin):
         # Look up if player is in DB. If not, add.
         c = self.db_query("SELECT name FROM Players WHERE name=?", name)
         if not c.fetchone():
-            self.db_query("INSERT INTO Players VALUES(?, 0, '', 0, 0)", name)
+            self.db_query("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) VALUES(?, 0, '', 0, 0)", name)
             self.db_query("INSERT INTO Ratings VALUES(?, ?, ?)", name, short_game_type, rating)
             self.db_commit()
             channel.reply("^6{}^7 was added as a player with a ^6{}^7 {} rating.".format(msg[1], rating, game.type))
-            if name in self.cache and short_game_type in self.cache[name]:
-                del self.cache[name][short_game_type]
+            events.publish(events.RATING_CHANGED, (name,))
             return
 
         c = self.db_query("SELECT game_type FROM Ratings WHERE name=?", name)
@@ -184,21 +204,19 @@ class balance(minqlbot.Plugin):
                 self.db_query("UPDATE Ratings SET rating=? WHERE name=? AND game_type=?", rating, name, short_game_type)
                 self.db_commit()
                 channel.reply("^6{}^7's {} rating has been updated to ^6{}^7.".format(msg[1], game.type, rating))
-                if name in self.cache and short_game_type in self.cache[name]:
-                    del self.cache[name][short_game_type]
+                events.publish(events.RATING_CHANGED, (name,))
                 return
 
         # We have the player, but the rating isn't set.
         self.db_query("INSERT INTO Ratings VALUES(?, ?, ?)", name, short_game_type, rating)
         self.db_commit()
         channel.reply("^6{}^7's {} rating was set to ^6{}^7.".format(msg[1], game.type, rating))
-        if name in self.cache and short_game_type in self.cache[name]:
-            del self.cache[name][short_game_type]
+        events.publish(events.RATING_CHANGED, (name,))
         return
 
     def cmd_getrating(self, player, msg, channel):
         if len(msg) < 2:
-            name = player.clean_name.lower()
+            name = playerkeys.key(player)
         else:
             name = self.clean_text(msg[1]).lower()
 
@@ -207,7 +225,7 @@ class balance(minqlbot.Plugin):
         
         game = self.game()
         short_game_type = game.short_type
-        c = self.db_query("SELECT rating FROM Ratings WHERE name=? AND game_type=?", name, short_game_type)
+        c = self.db_query(database.queries.RATING, name, short_game_type)
         row = c.fetchone()
         if not row:
             self.individual_rating(name, channel, short_game_type)
@@ -230,22 +248,55 @@ class balance(minqlbot.Plugin):
         else:
             self.db_commit()
             channel.reply("^6{}^7's {} rating data has been removed.".format(msg[1], game.type))
-            if name in self.cache and short_game_type in self.cache[name]:
-                del self.cache[name][short_game_type]
+            events.publish(events.RATING_CHANGED, (name,))
             return
 
+    def cmd_importratings(self, player, msg, channel):
+        if len(msg) < 2:
+            return minqlbot.RET_USAGE
+
+        path = " ".join(msg[1:])
+        # Runs in a single transaction on the database thread.
+        future = database.get_executor().call(database.import_ratings, path)
+        future.add_done_callback(lambda f: self.imported_ratings(f, path, channel))
+
+    def imported_ratings(self, future, path, channel):
+        e = future.exception()
+        if e:
+            channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
+            return
+
+        imported, skipped, changed = future.result()
+        # Drop what everyone had cached for the imported ratings in one go.
+        events.publish(events.RATING_CHANGED, set(name for name, game_type in changed))
+        channel.reply("^7Imported ^6{}^7 rating(s) from ^6{}^7, skipped ^6{}^7 invalid line(s)."
+            .format(imported, path, skipped))
+
+    def cmd_exportratings(self, player, msg, channel):
+        if len(msg) < 2:
+            return minqlbot.RET_USAGE
+
+        path = " ".join(msg[1:])
+        def exported(future):
+            e = future.exception()
+            if e:
+                channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
+            else:
+                channel.reply("^7Exported ^6{}^7 rating(s) to ^6{}^7.".format(future.result(), path))
+        database.get_executor().call(database.export_ratings, path).add_done_callback(exported)
+
     def fetch_player_ratings(self, names, channel, game_type, use_local=True, use_aliases=True):
         """Fetch ratings from the database and fall back to QLRanks.
 
         Takes into account ongoing lookups to avoid sending multiple requests for a player.
 
         """
-        config = minqlbot.get_config()
+        conf = self.settings
         # Fetch players from the database first if the config is set to do so.
-        if use_local and "Balance" in config and config["Balance"].getboolean("UseLocalRatings", fallback=False):
+        if use_local and conf.use_local_ratings:
             ratings = {"players": []}  # We follow QLRanks' JSON format.
             for name in names.copy():
-                c = self.db_query("SELECT game_type, rating FROM ratings WHERE name=?", name)
+                c = self.db_query(database.queries.RATINGS, name)
                 res = c.fetchall()
                 if res:
                     d = {"nick": name}
@@ -271,11 +322,8 @@ class balance(minqlbot.Plugin):
 
         # We fall back to QLRanks for players we don't have, but stop if we want a gametype it doesn't provide.
         if names and game_type in QLRANKS_GAMETYPES:
-            if use_aliases and "Balance" in config:
-                conf_alias = config["Balance"].getboolean("UseAliases", fallback=True)
-            else:
-                conf_alias = False
-            lookup = qlranks.QlRanks(self, names, check_alias=conf_alias)
+            conf_alias = use_aliases and conf.use_aliases
+            lookup = qlranks.QlRanks(self, names, check_alias=conf_alias, base_url=conf.qlranks_url)
             with self.rlock:
                 self.lookups[lookup.uid] = (lookup, names, channel)
             lookup.start()
@@ -287,19 +335,12 @@ class balance(minqlbot.Plugin):
         """Save the ratings of a player to the cache.
 
         """
-        config = minqlbot.get_config()
-
         if ratings == None:
             self.lookup_failed(lookup)
             return
         else:
-            floor = 0
-            ceiling = 0
-            if "Balance" in config:
-                if "FloorRating" in config["Balance"]:
-                    floor = int(config["Balance"]["FloorRating"])
-                if "CeilingRating" in config["Balance"]:
-                    ceiling = int(config["Balance"]["CeilingRating"])
+            floor = self.settings.floor_rating
+            ceiling = self.settings.ceiling_rating
 
             with self.rlock:
                 self.fails = 0 # Reset fail counter.
@@ -341,6 +382,19 @@ class balance(minqlbot.Plugin):
                 with self.rlock:
                     del self.lookups[lookup.uid]
 
+    def uncache(self, names):
+        """Drop cached ratings of names, or everyone's if names is None. Cached aliases
+        are keyed by the alias, so those pointing at one of the names go too.
+
+        """
+        with self.rlock:
+            if names is None:
+                self.cache.clear()
+                return
+            for name in list(self.cache):
+                if name in names or self.cache[name].get("alias_of") in names:
+                    del self.cache[name]
+
     def is_cached(self, name, game_type):
         """Checks if a player is cached or not.
 
@@ -356,20 +410,46 @@ class balance(minqlbot.Plugin):
 
         """
         not_cached = []
-        teams = self.teams()
         if player_list == None:
-            players = teams["red"] + teams["blue"] + teams["spectator"]
-        else:
-            players = player_list
+            teams = roster.get_roster().snapshot()
+            player_list = teams["red"] + teams["blue"] + teams["spectator"]
 
-        for player in players:
+        for player in player_list:
             if isinstance(player, str):
                 if not self.is_cached(player, game_type):
                     not_cached.append(player)
-            elif not self.is_cached(player.clean_name.lower(), game_type):
-                not_cached.append(player.clean_name.lower())
+            else:
+                name = playerkeys.key(player)
+                if not self.is_cached(name, game_type):
+                    not_cached.append(name)
         return not_cached
     
+    def wait_for_ratings(self, task, args, names, channel, game_type, **kwargs):
+        """Returns True if we have the ratings of every player in names. Otherwise we fetch
+        whatever isn't already being looked up, queue task(*args) to be called again once
+        the lookups are done and return False. Other plugins can use this too.
+
+        """
+        not_cached = self.not_cached(game_type, names)
+        if not not_cached:
+            return True
+
+        with self.rlock:
+            for lookup in self.lookups:
+                for n in self.lookups[lookup][1]:
+                    if n in not_cached:
+                        not_cached.remove(n)
+            if not_cached:
+                self.fetch_player_ratings(not_cached, channel, game_type, **kwargs)
+            if (task, args) not in self.pending:
+                self.pending.append((task, args))
+            return False
+
+    def get_rating(self, name, game_type):
+        """The cached rating of a player. Use wait_for_ratings first to make sure it's there."""
+        with self.rlock:
+            return self.cache[name][game_type]["elo"]
+
     def lookup_failed(self, lookup):
         """Handle lookups that failed due to timeouts and such
 
@@ -407,32 +487,17 @@ class balance(minqlbot.Plugin):
 
     def check_rating_requirements(self, names, channel, game_type):
         """Checks if someone meets the rating requirements to play on the server."""
-        config = minqlbot.get_config()
-        min_rating = 0
-        max_rating = 0
-        if "Balance" in config:
-            if "MinimumRating" in config["Balance"]:
-                min_rating = int(config["Balance"]["MinimumRating"])
-            if "MaximumRating" in config["Balance"]:
-                max_rating = int(config["Balance"]["MaximumRating"])
-        else:
-            return True
+        conf = self.settings
+        min_rating = conf.minimum_rating
+        max_rating = conf.maximum_rating
 
         if not min_rating and not max_rating:
             return True
 
-        not_cached = self.not_cached(game_type, names)
-        if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.check_rating_requirements, (names, channel, game_type)) not in self.pending:
-                    self.pending.append((self.check_rating_requirements, (names, channel, game_type)))
-                return False
+        if not self.wait_for_ratings(self.check_rating_requirements, (names, channel, game_type),
+            names, channel, game_type):
+            # A later call to execute_pending will come back to us.
+            return False
 
         for name in names:
             if "real_elo" in self.cache[name][game_type]:
@@ -441,8 +506,7 @@ class balance(minqlbot.Plugin):
                 rating = self.cache[name][game_type]["elo"]
 
             if (rating > max_rating and max_rating != 0) or (rating < min_rating and min_rating != 0):
-                allow_spec = config["Balance"].getboolean("AllowSpectators", fallback=True)
-                if allow_spec:
+                if conf.allow_spectators:
                     p = self.player(name)
                     if p.team != "spectator":
                         self.put(name, "spectator")
@@ -457,18 +521,10 @@ class balance(minqlbot.Plugin):
                     self.debug(name + " was kicked for not being within the rating requirements.")
 
     def individual_rating(self, name, channel, game_type):
-        not_cached = self.not_cached(game_type, (name,))
-        if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type, use_local=False, use_aliases=True)
-                if (self.individual_rating, (name, channel, game_type)) not in self.pending:
-                    self.pending.append((self.individual_rating, (name, channel, game_type)))
-                return False
+        if not self.wait_for_ratings(self.individual_rating, (name, channel, game_type),
+            (name,), channel, game_type, use_local=False, use_aliases=True):
+            # A later call to execute_pending will come back to us.
+            return False
 
         # NO DATA?
         short_game_type = game_type.upper()
@@ -511,20 +567,9 @@ class balance(minqlbot.Plugin):
             return True
         
         players = teams["red"] + teams["blue"]
-        not_cached = self.not_cached(game_type, players)
-        
-        if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.teams_info, (channel, game_type)) not in self.pending:
-                    self.pending.append((self.teams_info, (channel, game_type)))
-                # Let a later call to execute_pending come back to us.
-                return False
+        if not self.wait_for_ratings(self.teams_info, (channel, game_type), players, channel, game_type):
+            # A later call to execute_pending will come back to us.
+            return False
 
         avg_red = self.team_average(teams["red"], game_type)
         avg_blue = self.team_average(teams["blue"], game_type)
@@ -541,11 +586,7 @@ class balance(minqlbot.Plugin):
             channel.reply("^1{} ^7vs ^4{}^7 - Holy shit!"
                 .format(round(avg_red), round(avg_blue)))
 
-        config = minqlbot.get_config()
-        if "Balance" in config:
-            minimum_suggestion_diff = int(config["Balance"].get("MinimumSuggestionDifference", fallback="25"))
-        else:
-            minimum_suggestion_diff = 25
+        minimum_suggestion_diff = self.settings.minimum_suggestion_difference
 
         if switch and switch[1] >= minimum_suggestion_diff:
             channel.reply("^7SUGGESTION: switch ^6{}^7 with ^6{}^7. Type !a to agree."
@@ -574,20 +615,9 @@ class balance(minqlbot.Plugin):
             return True
 
         players = teams["red"] + teams["blue"]
-        not_cached = self.not_cached(game_type, players)
-
-        if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.average_balance, (channel, game_type)) not in self.pending:
-                    self.pending.append((self.average_balance, (channel, game_type)))
-                # Let a later call to execute_pending come back to us.
-                return False
+        if not self.wait_for_ratings(self.average_balance, (channel, game_type), players, channel, game_type):
+            # A later call to execute_pending will come back to us.
+            return False
         else:
             # Start out by evening out the number of players on each team.
             diff = len(teams["red"]) - len(teams["blue"])
@@ -676,7 +706,7 @@ class balance(minqlbot.Plugin):
         if team:
             with self.rlock:
                 for p in team:
-                    avg += self.cache[p.clean_name.lower()][game_type]["elo"]
+                    avg += self.cache[playerkeys.key(p)][game_type]["elo"]
                 avg /= len(team)
 
         return avg
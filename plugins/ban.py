@@ -19,16 +19,52 @@
 import datetime
 import re
 import plugins.qlprofile as qlprofile
+import plugins.database as database
+import plugins.aliasindex as aliasindex
+import plugins.settings as settings
+import plugins.events as events
+import plugins.playerkeys as playerkeys
+import plugins.roster as roster
+import plugins.scheduler as scheduler
+from plugins.settings import Setting
 import minqlbot
 import threading
+import traceback
+import time
 
 LENGTH_REGEX = re.compile(r"(?P<number>[0-9]+) (?P<scale>seconds?|minutes?|hours?|days?|weeks?|months?|years?)")
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 DEFAULT_REASON = "Reason not specified."
+SWEEP_INTERVAL = 3600
+SWEEP_BATCH_SIZE = 500
+LEAVERS_PAGE_SIZE = 10
+
+SETTINGS = (
+    Setting("minimum_days_registered", "MinimumDaysRegistered", int, 0),
+    Setting("ql_profile_url", "QlProfileUrl", str, qlprofile.QL_URL),
+    Setting("automatic_leave_ban", "AutomaticLeaveBan", bool, False),
+    Setting("minimum_games_played", "MinimumGamesPlayedBeforeBan", int, None),
+    Setting("warn_threshold", "WarnThreshold", float, None),
+    Setting("ban_threshold", "BanThreshold", float, None),
+    Setting("ban_sweep_interval", "BanSweepInterval", int, SWEEP_INTERVAL),
+    )
+
+def record_match(db, completed, leavers, match):
+    """Runs on the database thread, so the whole match is committed at once."""
+    db.db_querymany("UPDATE Players SET games_completed=games_completed+1, "
+        "completion_ratio=(games_completed+1.0)/(games_completed+games_left+1) WHERE name=?",
+        *[(name,) for name in completed])
+    db.db_querymany("UPDATE Players SET games_left=games_left+1, "
+        "completion_ratio=CAST(games_completed AS REAL)/(games_completed+games_left+1) WHERE name=?",
+        *[(name,) for name in leavers])
+    db.db_query("INSERT INTO Matches(started, ended, game_type, map, winner, completed, leavers) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?)", *match)
 
 class ban(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        settings.register(self, "Ban", SETTINGS)
+        self.add_hook("unload", self.handle_unload)
         self.add_hook("player_connect", self.handle_player_connect, minqlbot.PRI_HIGH)
         self.add_hook("game_countdown", self.handle_game_countdown)
         self.add_hook("bot_connect", self.handle_bot_connect)
@@ -36,13 +72,39 @@ class ban(minqlbot.Plugin):
         self.add_hook("game_end", self.handle_game_end)
         self.add_hook("team_switch", self.handle_team_switch)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
+        events.subscribe(self, events.BAN_CHANGED, self.handle_ban_changed)
         self.add_command("ban", self.cmd_ban, 2, usage="<full_name> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unban", self.cmd_unban, 2, usage="<full_name>")
         self.add_command("checkban", self.cmd_checkban, usage="<full_name>")
         self.add_command("forgive", self.cmd_forgive, 2, usage="<full_name> <leaves_to_forgive>")
-
-        self.players_start = []
+        self.add_command("leavers", self.cmd_leavers, 2, usage="[page]")
+
+        # Keys: lowercase clean name - Items: {"player": Player, "joined": float, "left": float or None}
+        self.participants = {}
+        self.match_started = None
+
+        database.migrate(self)
+        self.sweep_timer = None
+        self.unloaded = False
+        # Sweep once right away, then every BanSweepInterval.
+        self.schedule_sweep(0)
+
+    def handle_unload(self):
+        self.unloaded = True
+        settings.unregister(self)
+        events.unsubscribe(self)
+        if self.sweep_timer:
+            self.sweep_timer.cancel()
+        scheduler.cancel("ban.warn")
     
+    def handle_ban_changed(self, names):
+        """A pending leaver warning might not hold anymore, like after a !forgive."""
+        if names is None:
+            scheduler.cancel("ban.warn")
+        else:
+            for name in names:
+                scheduler.cancel(("ban.warn", name))
+
     def handle_player_connect(self, player):
         status = self.leave_status(player.name)
         # Check if a player has been banned for leaving, if we're doing that.
@@ -52,18 +114,17 @@ class ban(minqlbot.Plugin):
             return minqlbot.RET_STOP
         # Check if player needs to be warned.
         elif status and status[0] == "warn":
-            self.delay(12, self.warn_player, args=(player, status[1]))
+            scheduler.schedule(12, self.warn_player, args=(player, status[1]), key=("ban.warn", playerkeys.key(player)))
         # Check if a player has been banned manually.
         elif self.is_banned(player.name):
             self.kickban(player)
             # Stop plugins on lowest priority from triggering this event since we're kicking.
             return minqlbot.RET_STOP
 
-        config = minqlbot.get_config()
-        if "Ban" in config and "MinimumDaysRegistered" in config["Ban"]:
-            days = int(config["Ban"]["MinimumDaysRegistered"])
-            if days > 0:
-                threading.Thread(target=self.get_profile_thread, args=(player.clean_name, days)).start()
+        days = self.settings.minimum_days_registered
+        if days > 0:
+            threading.Thread(target=self.get_profile_thread,
+                args=(player.clean_name, days, self.settings.ql_profile_url)).start()
 
     def handle_game_countdown(self):
         if self.is_leaver_banning():
@@ -71,56 +132,64 @@ class ban(minqlbot.Plugin):
 
     def handle_bot_connect(self):
         if self.game().state == "in_progress":
-            self.players_start = []
-            teams = self.teams()
-            self.players_start = teams["red"] + teams["blue"]
+            self.start_tracking()
 
     def handle_game_start(self, game):
-        self.players_start = []
-        teams = self.teams()
-        self.players_start = teams["red"] + teams["blue"]
+        self.start_tracking()
 
     def handle_game_end(self, game, score, winner):
+        # Ask the server rather than the roster, which can be a few events behind, since
+        # getting this wrong gets people banned for leaving.
         teams = self.teams()
-        players_end = teams["red"] + teams["blue"]
+        players_end = set(playerkeys.key(p) for p in teams["red"] + teams["blue"])
+        completed = []
         leavers = []
+        for name, entry in self.participants.items():
+            if name in players_end:
+                completed.append(name)
+            else:
+                leavers.append(entry["player"])
 
-        for player in self.players_start.copy():
-            if player not in players_end:
-                # Populate player list.
-                leavers.append(player)
-                # Remove leavers from initial list so we can use it to award games completed.
-                self.players_start.remove(player)
-
-        self.db_querymany("UPDATE players SET games_completed=games_completed+1 WHERE name=?",
-            *[(p.clean_name.lower(),) for p in self.players_start])
-        self.db_querymany("UPDATE players SET games_left=games_left+1 WHERE name=?",
-            *[(p.clean_name.lower(),) for p in leavers])
-        self.db_commit()
+        # Everything goes in a single transaction on the database thread. No need to wait for it.
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        match = (self.match_started or now, now, game.short_type, game.map, str(winner), len(completed), len(leavers))
+        database.get_executor().call(record_match, completed, [playerkeys.key(p) for p in leavers], match)
 
         if leavers:
             self.msg("^7Leavers: ^6{}".format(" ".join([p.clean_name for p in leavers])))
-            self.players_start = []
+        self.participants = {}
+        self.match_started = None
 
     def handle_team_switch(self, player, old_team, new_team):
+        name = playerkeys.key(player)
         # Allow people to spectate without getting a leave if teams are uneven.
         if (old_team == "red" or old_team == "blue") and new_team == "spectator":
-            teams = self.teams()
-            if len(teams["red"] + teams["blue"]) % 2 == 0 and player in self.players_start:
-                self.players_start.remove(player)
-                self.debug("Removed {} from start list for speccing.".format(player.clean_name))
+            if self.is_participating(name):
+                if self.is_even():
+                    del self.participants[name]
+                    self.debug("Removed {} from start list for speccing.".format(player.clean_name))
+                else:
+                    self.participants[name]["left"] = time.time()
         # Add people to the list of participating players if they join mid-game.
         if (old_team == "spectator" and (new_team == "red" or new_team == "blue") and
-         self.game().state == "in_progress" and player not in self.players_start):
-            self.players_start.append(player)
-            self.debug("Added {} to start list for joining.".format(player.clean_name))
+         self.game().state == "in_progress"):
+            if name not in self.participants:
+                self.participants[name] = {"player": player, "joined": time.time(), "left": None}
+                self.debug("Added {} to start list for joining.".format(player.clean_name))
+            else:
+                self.participants[name]["left"] = None
 
     def handle_player_disconnect(self, player, reason):
+        name = playerkeys.key(player)
+        # Only look at the teams if the player was actually taking part.
+        if not self.is_participating(name):
+            return
         # Allow people to disconnect without getting a leave if teams are uneven.
-        teams = self.teams()
-        if len(teams["red"] + teams["blue"]) % 2 == 0 and player in self.players_start:
-            self.players_start.remove(player)
+        if self.is_even():
+            del self.participants[name]
             #self.debug("Removed {} from start list for disconnecting.".format(player.clean_name))
+        else:
+            self.participants[name]["left"] = time.time()
 
     def cmd_ban(self, player, msg, channel):
         if len(msg) < 4:
@@ -137,9 +206,9 @@ class ban(minqlbot.Plugin):
         else:
             reason = DEFAULT_REASON
 
-        c = self.db_query("SELECT * FROM Players WHERE name=?", name.lower())
+        c = self.db_query(database.queries.PLAYER, name.lower())
         if not c.fetchone():
-            self.db_query("INSERT INTO Players VALUES(?, 0, '', 0, 0)", name.lower())
+            self.db_query("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) VALUES(?, 0, '', 0, 0)", name.lower())
             self.db_commit()
         
         r = LENGTH_REGEX.match(" ".join(msg[2:4]).lower())
@@ -168,6 +237,7 @@ class ban(minqlbot.Plugin):
             expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
             self.db_query("INSERT INTO Bans VALUES(?, ?, ?, 1, ?)", name.lower(), now, expires, reason)
             self.db_commit()
+            events.publish(events.BAN_CHANGED, (name.lower(),))
             self.kickban(name)
             channel.reply("^6{} ^7has been banned. Ban expires on ^6{}^7.".format(name, expires))
             return
@@ -177,15 +247,12 @@ class ban(minqlbot.Plugin):
             return minqlbot.RET_USAGE
 
         name = self.clean_text(msg[1])
-        c = self.db_query("SELECT * FROM Bans WHERE name=?", name.lower())
-        unbanned = False
-        for row in c:
-            if row[3]: # if active ban
-                self.db_query("UPDATE Bans SET active=0 WHERE name=? AND issued=?", row[0], row[1])
-                self.db_commit()
-                unbanned = True
+        c = self.db_query("UPDATE Bans SET active=0 WHERE name=? AND active=1", name.lower())
+        unbanned = c.rowcount > 0
+        self.db_commit()
         
         if unbanned:
+            events.publish(events.BAN_CHANGED, (name.lower(),))
             channel.reply("^6{}^7 has been unbanned.".format(name))
         else:
             channel.reply("^7 No active bans on ^6{}^7 found.".format(name))
@@ -214,7 +281,8 @@ class ban(minqlbot.Plugin):
         if len(msg) < 3:
             return minqlbot.RET_USAGE
 
-        c = self.db_query("SELECT games_left FROM Players WHERE name=?", msg[1])
+        name = playerkeys.key(msg[1])
+        c = self.db_query("SELECT games_left FROM Players WHERE name=?", name)
         row = c.fetchone()
         if not row:
             channel.reply("^7I do not know^6 {}^7.".format(msg[1]))
@@ -235,50 +303,131 @@ class ban(minqlbot.Plugin):
         else:
             forgiven = leaves_to_forgive
 
-        self.db_query("UPDATE Players SET games_left=games_left-? WHERE name=?", forgiven, msg[1])
+        self.db_query("UPDATE Players SET games_left=games_left-?1, completion_ratio="
+            "CASE WHEN games_completed+games_left-?1 > 0 THEN CAST(games_completed AS REAL)/(games_completed+games_left-?1) END "
+            "WHERE name=?2", forgiven, name)
         self.db_commit()
+        events.publish(events.BAN_CHANGED, (name,))
         channel.reply("^7^6{}^7 games have been forgiven, putting ^6{}^7 at ^6{}^7 leaves."
             .format(forgiven, msg[1], row["games_left"] - forgiven))
 
+    def cmd_leavers(self, player, msg, channel):
+        if not self.is_leaver_banning():
+            channel.reply("^7Automatic leaver banning is not configured.")
+            return
+
+        page = 1
+        if len(msg) > 1:
+            try:
+                page = int(msg[1])
+            except ValueError:
+                return minqlbot.RET_USAGE
+            if page < 1:
+                return minqlbot.RET_USAGE
+
+        conf = self.settings
+        min_games_completed = conf.minimum_games_played
+        warn_threshold = conf.warn_threshold
+        ban_threshold = conf.ban_threshold
+
+        # A range scan on the completion_ratio index, worst offenders first.
+        c = self.db_query(database.queries.LEAVERS, warn_threshold, LEAVERS_PAGE_SIZE + 1, (page - 1) * LEAVERS_PAGE_SIZE)
+        rows = c.fetchall()
+        if not rows:
+            channel.reply("^7No leavers found on page ^6{}^7.".format(page))
+            return
+
+        entries = []
+        for row in rows[:LEAVERS_PAGE_SIZE]:
+            total = row["games_completed"] + row["games_left"]
+            if row["completion_ratio"] <= ban_threshold and total >= min_games_completed:
+                color = "^1"
+            else:
+                color = "^3"
+            entries.append("{}{}^7: {}% ({}/{})".format(color, row["name"],
+                round(row["completion_ratio"] * 100, 1), row["games_completed"], total))
+        channel.reply("^7Leavers, page ^6{}^7: {}".format(page, ", ".join(entries)))
+        if len(rows) > LEAVERS_PAGE_SIZE:
+            channel.reply("^7Use ^6!leavers {}^7 for more.".format(page + 1))
 
     # ====================================================================
     #                               HELPERS
     # ====================================================================
 
+    def start_tracking(self):
+        """Populate the participants with everyone currently on a team.
+
+        """
+        teams = self.teams()
+        now = time.time()
+        self.participants = {playerkeys.key(p): {"player": p, "joined": now, "left": None}
+                             for p in teams["red"] + teams["blue"]}
+        self.match_started = datetime.datetime.now().strftime(TIME_FORMAT)
+
+    def is_participating(self, name):
+        return name in self.participants and self.participants[name]["left"] is None
+
+    def is_even(self):
+        return roster.get_roster().count("red", "blue") % 2 == 0
+
     def is_banned(self, name):
-        clean = self.clean_name(name).lower()
-        c = self.db_query("SELECT * FROM Bans WHERE name=?", clean)
-        for row in c:
-            if clean == row["name"] and row["active"]:
-                expires = datetime.datetime.strptime(row["expires"], TIME_FORMAT)
-                if (expires - datetime.datetime.now()).total_seconds() > 0:
-                    return row["expires"], row["reason"]
+        clean = playerkeys.key(name)
+        # A ban on the main account applies to its aliases too.
+        main = aliasindex.get_index().resolve(clean)
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        # TIME_FORMAT sorts chronologically, so the index on (name, active, expires) covers this.
+        c = self.db_query(database.queries.ACTIVE_BAN, clean, main, now)
+        row = c.fetchone()
+        if row:
+            return row["expires"], row["reason"]
         return None
+
+    def schedule_sweep(self, delay=None):
+        interval = self.settings.ban_sweep_interval
+        # Zero would have it sweep nonstop, so treat it as disabled too.
+        if self.unloaded or interval <= 0:
+            return
+        # It waits on the database, so don't hold up other timers.
+        self.sweep_timer = scheduler.schedule(interval if delay is None else delay, self.sweep_expired_bans, thread=True)
+
+    def sweep_expired_bans(self):
+        """Deactivate expired bans in batches, so lookups only ever see a name's live bans.
+
+        """
+        try:
+            executor = database.get_executor()
+            now = datetime.datetime.now().strftime(TIME_FORMAT)
+            total = 0
+            while True:
+                # Each batch gets committed before we queue the next, so others get a turn in between.
+                count = executor.execute(database.queries.SWEEP_BANS, now, SWEEP_BATCH_SIZE).result()
+                total += count
+                if count < SWEEP_BATCH_SIZE:
+                    break
+            if total:
+                self.debug("Deactivated {} expired ban(s).".format(total))
+        finally:
+            self.schedule_sweep()
     
-    def get_profile_thread(self, name, days):
+    def get_profile_thread(self, name, days, base_url=qlprofile.QL_URL):
         try:
-            pro = qlprofile.get_profile(name)
+            # We only need the registration date, so stop reading the page once we have it.
+            pro = qlprofile.get_profile(name, fields=("created",), base_url=base_url)
             if not pro.is_eligible(days):
                 self.debug("{} WAS KICKED FOR BEING AN ACCOUNT CREATED IN THE LAST {} DAYS.".format(name, days))
                 self.kickban(name)
         except:
             e = traceback.format_exc().rstrip("\n")
-            debug("========== ERROR: {}@get_profile_thread ==========".format(self.__class__.__name__))
+            minqlbot.debug("========== ERROR: {}@get_profile_thread ==========".format(self.__class__.__name__))
             for line in e.split("\n"):
-                debug(line)
+                minqlbot.debug(line)
 
     def is_leaver_banning(self):
-        config = minqlbot.get_config()
-
-        if ("Ban" in config and
-            "AutomaticLeaveBan" in config["Ban"] and
-            config["Ban"].getboolean("AutomaticLeaveBan") and
-            "MinimumGamesPlayedBeforeBan" in config["Ban"] and
-            "WarnThreshold" in config["Ban"] and
-            "BanThreshold" in config["Ban"]):
-            return True
-        else:
-            return False
+        conf = self.settings
+        return (conf.automatic_leave_ban and
+            conf.minimum_games_played is not None and
+            conf.warn_threshold is not None and
+            conf.ban_threshold is not None)
 
     def leave_status(self, name):
         """Get a player's status when it comes to leaving, given automatic leaver ban is on.
@@ -287,16 +436,15 @@ class ban(minqlbot.Plugin):
         if not self.is_leaver_banning():
             return None
 
-        c = self.db_query("SELECT * FROM Players WHERE name=?", self.clean_name(name).lower())
+        c = self.db_query(database.queries.PLAYER, playerkeys.key(name))
         row = c.fetchone()
         if not row:
             return None
 
-        config = minqlbot.get_config()
-        
-        min_games_completed = int(config["Ban"]["MinimumGamesPlayedBeforeBan"])
-        warn_threshold = float(config["Ban"]["WarnThreshold"])
-        ban_threshold = float(config["Ban"]["BanThreshold"])
+        conf = self.settings
+        min_games_completed = conf.minimum_games_played
+        warn_threshold = conf.warn_threshold
+        ban_threshold = conf.ban_threshold
 
         # Check their games completed to total games ratio.
         total = row["games_completed"] + row["games_left"]
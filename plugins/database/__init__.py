@@ -0,0 +1,7 @@
+import plugins.database.queries as queries
+from plugins.database.database import migrate, schema_version, MIGRATIONS, HOT_PATH_QUERIES, database_path, database_profile, apply_profile, configure
+from plugins.database.executor import Executor, get_executor, stop_executor
+from plugins.database.stats import STATS, normalize, install as install_stats, uninstall as uninstall_stats
+from plugins.database.backup import backup, list_backups, prune_backups
+from plugins.database.maintenance import prune_players, incremental_vacuum, auto_vacuum_pending, enable_auto_vacuum
+from plugins.database.ratings import import_ratings, export_ratings
\ No newline at end of file
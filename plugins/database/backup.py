@@ -0,0 +1,104 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Online backups of the database using SQLite's backup API.
+
+The database is copied a few pages at a time with a short sleep in between, so the
+bot keeps reading and writing while a backup runs. The backup reads through its own
+connection, which in WAL mode holds a single read transaction for the whole copy. It
+then copies the database as it was when it started, instead of starting over every
+time the executor commits. Without WAL, the database is copied in a single step.
+"""
+
+import datetime
+import sqlite3
+import time
+import os
+
+BACKUP_PREFIX = "minqlbot-"
+BACKUP_SUFFIX = ".db"
+BACKUP_TIME_FORMAT = "%Y%m%d-%H%M%S"
+PAGES_PER_STEP = 64
+SLEEP_PER_STEP = 0.005
+
+def backup(source_path, folder, pages=PAGES_PER_STEP, sleep=SLEEP_PER_STEP, progress=None):
+    """Copy the database at source_path into a new timestamped file in folder.
+    progress, if given, is called with (pages_copied, total_pages). Returns
+    (backup_path, total_pages, seconds).
+
+    """
+    os.makedirs(folder, exist_ok=True)
+    name = BACKUP_PREFIX + datetime.datetime.now().strftime(BACKUP_TIME_FORMAT) + BACKUP_SUFFIX
+    path = os.path.join(folder, name)
+    # Write to a temporary file, so a half finished backup never looks like a real one.
+    temp_path = path + ".part"
+    totals = [0]
+
+    def step(status, remaining, total):
+        totals[0] = total
+        if progress:
+            progress(total - remaining, total)
+        # sqlite3 only sleeps between steps when the database is busy, so we always yield here.
+        if remaining:
+            time.sleep(sleep)
+
+    start = time.perf_counter()
+    source = sqlite3.connect(source_path, isolation_level=None)
+    try:
+        # Readers don't block writers in WAL mode, so hold on to one snapshot throughout.
+        # Otherwise holding a read lock that long would, so copy it all in one go instead,
+        # which can't be restarted halfway either.
+        if source.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal":
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        else:
+            pages = -1
+        target = sqlite3.connect(temp_path)
+        try:
+            source.backup(target, pages=pages, progress=step)
+        finally:
+            target.close()
+        os.replace(temp_path, path)
+    finally:
+        source.close()
+        # Only left over if something went wrong.
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path, totals[0], time.perf_counter() - start
+
+def list_backups(folder):
+    """Backups in folder, oldest first."""
+    if not os.path.isdir(folder):
+        return []
+    names = [n for n in os.listdir(folder) if n.startswith(BACKUP_PREFIX) and n.endswith(BACKUP_SUFFIX)]
+    # The timestamp format sorts chronologically.
+    return [os.path.join(folder, n) for n in sorted(names)]
+
+def prune_backups(folder, keep, newest=None):
+    """Delete all but the newest keep backups, never deleting the backup at newest, like
+    the one that was just made. A keep of 0 or less keeps them all. Returns the deleted
+    paths.
+
+    """
+    if keep <= 0:
+        return []
+    backups = list_backups(folder)
+    old = [path for path in backups[:-keep] if newest is None or os.path.abspath(path) != os.path.abspath(newest)]
+    for path in old:
+        os.remove(path)
+    return old
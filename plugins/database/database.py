@@ -0,0 +1,299 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Versioned schema migrations for minqlbot.db.
+
+The schema version is kept in SQLite's user_version pragma. Each migration is applied
+in order, exactly once, and bumps the version when it's done. Plugins that depend on
+the schema call migrate(self) when they're loaded, which is a single pragma read once
+the database is up to date. db.txt documents what the schema looks like in the end.
+
+To add a migration, append a function to MIGRATIONS. Never change or reorder old ones.
+Running this file checks that none of the hot path queries do a full table scan.
+"""
+
+import threading
+import sqlite3
+import time
+import sys
+import os
+
+import plugins.database.queries as queries
+import plugins.settings as settings
+from plugins.settings import Setting
+
+_lock = threading.RLock()
+
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+
+def one_of(choices):
+    def parse(value):
+        value = value.upper()
+        if value not in choices:
+            raise ValueError("Must be one of: {}".format(", ".join(choices)))
+        return value
+    return parse
+
+# The [Database] config section.
+SETTINGS = (
+    Setting("journal_mode", "JournalMode", one_of(JOURNAL_MODES), "WAL"),
+    Setting("synchronous", "Synchronous", one_of(SYNCHRONOUS_LEVELS), "NORMAL"),
+    Setting("busy_timeout", "BusyTimeout", int, 5000),
+    Setting("cache_size", "CacheSize", int, -8000),
+    Setting("mmap_size", "MmapSize", int, 67108864),
+    )
+
+def migration_1(db):
+    """The original schema. Older databases already have these tables."""
+    db.db_query("""CREATE TABLE IF NOT EXISTS Players (
+        name                TEXT PRIMARY KEY,
+        permission          INT NOT NULL,
+        last_seen           DATE,
+        games_completed     INT NOT NULL,
+        games_left          INT NOT NULL)""")
+    db.db_query("""CREATE TABLE IF NOT EXISTS Aliases (
+        name        TEXT,
+        other_name  TEXT,
+        PRIMARY KEY(name, other_name),
+        FOREIGN KEY(name) REFERENCES Players(name) ON DELETE CASCADE)""")
+    db.db_query("""CREATE TABLE IF NOT EXISTS Bans (
+        name        TEXT,
+        issued      DATE,
+        expires     DATE NOT NULL,
+        active      BOOLEAN NOT NULL,
+        reason      TEXT,
+        PRIMARY KEY (name, issued),
+        FOREIGN KEY(name) REFERENCES Players(name) ON DELETE CASCADE)""")
+    db.db_query("""CREATE TABLE IF NOT EXISTS Motd (
+        time        INT PRIMARY KEY,
+        name        TEXT NOT NULL,
+        message     TEXT,
+        FOREIGN KEY(name) REFERENCES Players(name))""")
+    db.db_query("""CREATE TABLE IF NOT EXISTS Ratings (
+        name        TEXT NOT NULL,
+        game_type   TEXT NOT NULL,
+        rating      INT  NOT NULL,
+        PRIMARY KEY (name, game_type),
+        FOREIGN KEY(name) REFERENCES Players(name) ON DELETE CASCADE)""")
+
+def migration_2(db):
+    """Match records and the stored completion ratio used by !leavers."""
+    db.db_query("""CREATE TABLE IF NOT EXISTS Matches (
+        id          INTEGER PRIMARY KEY,
+        started     DATE,
+        ended       DATE NOT NULL,
+        game_type   TEXT,
+        map         TEXT,
+        winner      TEXT,
+        completed   INT NOT NULL,
+        leavers     INT NOT NULL)""")
+    if not has_column(db, "Players", "completion_ratio"):
+        db.db_query("ALTER TABLE Players ADD COLUMN completion_ratio REAL")
+        db.db_query("UPDATE Players SET completion_ratio=CAST(games_completed AS REAL)/(games_completed+games_left) "
+            "WHERE games_completed+games_left > 0")
+    db.db_query("CREATE INDEX IF NOT EXISTS Players_completion_ratio ON Players(completion_ratio)")
+
+def migration_3(db):
+    """Indexes for the queries run on hot paths."""
+    # Alias resolution in QlRanks.run and !getalias.
+    db.db_query("CREATE INDEX IF NOT EXISTS Aliases_other_name ON Aliases(other_name)")
+    # is_banned on every connect.
+    db.db_query("CREATE INDEX IF NOT EXISTS Bans_name_active_expires ON Bans(name, active, expires)")
+
+def migration_4(db):
+    """An index for pruning. Incremental auto vacuum, so pruning can give space back,
+    is switched on by dbmaint's !maintenance, since on an existing database it takes a
+    full VACUUM, which could hold up loading the plugins for a long time.
+
+    """
+    db.db_query("CREATE INDEX IF NOT EXISTS Players_last_seen ON Players(last_seen)")
+
+def migration_5(db):
+    """An index for the background sweep of expired bans."""
+    db.db_query("CREATE INDEX IF NOT EXISTS Bans_active_expires ON Bans(active, expires)")
+
+MIGRATIONS = (migration_1, migration_2, migration_3, migration_4, migration_5)
+
+# Queries run on connect and other hot paths, checked by running this file.
+HOT_PATH_QUERIES = (
+    (queries.PLAYER, ("a",)),
+    (queries.LAST_SEEN, ("a",)),
+    (queries.UPDATE_LAST_SEEN, ("b", "a")),
+    (queries.ACTIVE_BAN, ("a", "b", "c")),
+    (queries.SWEEP_BANS, ("a", 100)),
+    (queries.RATINGS, ("a",)),
+    (queries.RATING, ("a", "ca")),
+    (queries.CURRENT_MOTD, ()),
+    (queries.LEAVERS, (0.5, 10, 0)),
+    )
+
+def has_column(db, table, column):
+    c = db.db_query("PRAGMA table_info({})".format(table))
+    return column in [row[1] for row in c.fetchall()]
+
+def schema_version(db):
+    return db.db_query("PRAGMA user_version").fetchone()[0]
+
+def migrate(db):
+    """Bring the database up to date. Takes a plugin, or anything else with
+    db_query and db_commit. Returns the number of migrations applied.
+
+    """
+    with _lock:
+        version = schema_version(db)
+        applied = 0
+        for i in range(version, len(MIGRATIONS)):
+            MIGRATIONS[i](db)
+            # Pragmas can't take parameters, but this is always an int.
+            db.db_query("PRAGMA user_version={}".format(i + 1))
+            db.db_commit()
+            applied += 1
+        return applied
+
+def database_path(config):
+    return config["Core"].get("DatabasePath", fallback="python\\minqlbot.db")
+
+def database_profile(config):
+    """Parse the [Database] section of the config into a snapshot of pragma settings.
+    Unlike plugin settings, bad values raise ValueError instead of falling back to the
+    default, since the connection is only configured once.
+
+    """
+    profile, errors = settings.compile_section(config, "Database", SETTINGS)
+    if errors:
+        raise ValueError("; ".join(errors))
+    return profile
+
+def apply_profile(db, profile):
+    """Apply pragma settings to a connection. journal_mode=WAL is stored in the database
+    file, but the rest is per connection, so this needs to run on every connection.
+
+    """
+    # Pragmas can't take parameters, but everything here has been validated above.
+    db.db_query("PRAGMA journal_mode={}".format(profile.journal_mode))
+    db.db_query("PRAGMA synchronous={}".format(profile.synchronous))
+    db.db_query("PRAGMA busy_timeout={}".format(profile.busy_timeout))
+    db.db_query("PRAGMA cache_size={}".format(profile.cache_size))
+    db.db_query("PRAGMA mmap_size={}".format(profile.mmap_size))
+
+def configure(db, config=None):
+    """Apply the [Database] profile to the connection db_query uses on the calling thread.
+
+    """
+    if config is None:
+        import minqlbot
+        config = minqlbot.get_config()
+    apply_profile(db, database_profile(config))
+
+class Connection():
+    """Wraps a plain sqlite3 connection in the plugin database interface."""
+    def __init__(self, path, profile=None):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        if profile:
+            apply_profile(self, profile)
+
+    def db_query(self, query, *params):
+        return self.connection.execute(query, params)
+
+    def db_querymany(self, query, *params):
+        return self.connection.executemany(query, params)
+
+    def db_commit(self):
+        self.connection.commit()
+
+    def db_close(self):
+        self.connection.close()
+
+def check_query_plans(db):
+    """Return the hot path queries that make SQLite scan a whole table."""
+    scans = []
+    for query, params in HOT_PATH_QUERIES:
+        for row in db.db_query("EXPLAIN QUERY PLAN " + query, *params):
+            detail = row[-1]
+            if detail.startswith("SCAN") and "USING" not in detail:
+                scans.append((query, detail))
+    return scans
+
+def benchmark(path, journal_mode, seconds=3, readers=4):
+    """Time reads on worker threads while the main thread writes and commits one row at
+    a time, the way the plugins do. Returns (reads, writes, busy errors).
+
+    """
+    profile = database_profile(None)._replace(journal_mode=journal_mode)
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db = Connection(path, profile)
+    migrate(db)
+    db.db_querymany("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) "
+        "VALUES(?, 0, '', 0, 0)", *[("player{}".format(i),) for i in range(5000)])
+    db.db_commit()
+
+    stop = time.time() + seconds
+    counts = {"reads": 0, "busy": 0}
+    counts_lock = threading.Lock()
+
+    def read():
+        # Like QlRanks.run, every thread gets its own connection.
+        reader = Connection(path, profile)
+        i = 0
+        while time.time() < stop:
+            try:
+                reader.db_query("SELECT * FROM Players WHERE name=?", "player{}".format(i % 5000)).fetchone()
+                with counts_lock:
+                    counts["reads"] += 1
+            except sqlite3.OperationalError:
+                with counts_lock:
+                    counts["busy"] += 1
+            i += 1
+        reader.db_close()
+
+    threads = [threading.Thread(target=read) for i in range(readers)]
+    for t in threads:
+        t.start()
+    writes = 0
+    while time.time() < stop:
+        db.db_query("UPDATE Players SET last_seen=? WHERE name=?", str(time.time()), "player{}".format(writes % 5000))
+        db.db_commit()
+        writes += 1
+    for t in threads:
+        t.join()
+    db.db_close()
+    return counts["reads"], writes, counts["busy"]
+
+if __name__ == "__main__":
+    # Usage: database.py --benchmark <scratch_path> -- compare rollback journal and WAL
+    # with concurrent reads during write bursts.
+    if len(sys.argv) > 2 and sys.argv[1] == "--benchmark":
+        for mode in ("DELETE", "WAL"):
+            reads, writes, busy = benchmark(sys.argv[2], mode)
+            print("{:>6}: {} reads, {} commits, {} busy errors".format(mode, reads, writes, busy))
+        sys.exit()
+
+    # Usage: database.py [path] -- migrates the given database, or an empty one in memory,
+    # and fails if any hot path query does a full table scan.
+    db = Connection(sys.argv[1] if len(sys.argv) > 1 else ":memory:")
+    print("Applied {} migration(s), now at version {}.".format(migrate(db), schema_version(db)))
+    scans = check_query_plans(db)
+    for query, detail in scans:
+        print("FULL SCAN: {} -> {}".format(query, detail))
+    if scans:
+        sys.exit(1)
+    print("All {} hot path queries use an index.".format(len(HOT_PATH_QUERIES)))
@@ -0,0 +1,272 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""A thread that owns a SQLite connection and runs queries for everyone else.
+
+Queries are submitted from any thread and return a concurrent.futures.Future. Reads
+resolve to a list of rows as soon as they've run. Writes from all plugins are grouped
+and committed once per tick, and their futures resolve to the row count after the
+commit. Callers that don't care about the result can simply drop the future, so a hook
+handler never has to wait on SQLite.
+"""
+
+from concurrent.futures import Future
+import threading
+import sqlite3
+import queue
+import time
+
+from plugins.database.database import Connection, database_path, database_profile, migrate
+from plugins.database.stats import timed
+
+TICK = 0.05
+
+READ = 0
+WRITE = 1
+WRITE_MANY = 2
+CALL = 3
+
+class Executor(threading.Thread):
+    def __init__(self, path, profile=None, tick=TICK):
+        threading.Thread.__init__(self, name="DatabaseExecutor", daemon=True)
+        self.path = path
+        self.profile = profile
+        self.tick = tick
+        self.tasks = queue.Queue()
+        self.running = True
+        self.commits = 0
+        self.ready = threading.Event()
+        self.error = None
+
+    def query(self, query, *params):
+        """Run a read and get a Future resolving to a list of rows."""
+        return self.submit(READ, query, params)
+
+    def execute(self, query, *params):
+        """Queue a write. The Future resolves to the row count once it's been committed."""
+        return self.submit(WRITE, query, params)
+
+    def executemany(self, query, *params):
+        return self.submit(WRITE_MANY, query, params)
+
+    def call(self, func, *args):
+        """Run func(connection, *args) on the executor thread. Anything it writes is
+        committed with the rest of the tick."""
+        return self.submit(CALL, func, args)
+
+    def submit(self, kind, what, params):
+        future = Future()
+        if threading.current_thread() is self:
+            # Submitted from a done callback. Waiting on the queue would deadlock, so run it now.
+            written = []
+            self.run_task((kind, what, params, future), written)
+            if written:
+                self.commit(written)
+            return future
+        elif not self.running:
+            future.set_exception(RuntimeError("The database executor has been stopped."))
+            return future
+        self.tasks.put((kind, what, params, future))
+        return future
+
+    def stop(self, timeout=None):
+        """Commit whatever is queued and close the connection."""
+        self.running = False
+        self.tasks.put(None)
+        self.join(timeout)
+
+    def run(self):
+        try:
+            self.connection = Connection(self.path, self.profile)
+            migrate(self.connection)
+        except Exception as e:
+            self.error = e
+            self.running = False
+            self.ready.set()
+            return
+        self.ready.set()
+
+        stop = False
+        while not stop:
+            try:
+                task = self.tasks.get(timeout=self.tick)
+            except queue.Empty:
+                continue
+
+            # Run everything that comes in during this tick, then commit once.
+            deadline = time.time() + self.tick
+            written = []
+            while True:
+                if task is None:
+                    stop = True
+                else:
+                    self.run_task(task, written)
+                if time.time() >= deadline:
+                    break
+                try:
+                    task = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+
+            if written:
+                self.commit(written)
+
+        # Anything that was queued after the sentinel.
+        written = []
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None:
+                self.run_task(task, written)
+        if written:
+            self.commit(written)
+        self.connection.db_close()
+
+    def run_task(self, task, written):
+        try:
+            self.do_task(task, written)
+        except BaseException as e:
+            # Whatever goes wrong, the thread has to keep going, or everyone waiting on a
+            # future would wait forever.
+            future = task[3]
+            if not future.done():
+                future.set_exception(e)
+
+    def do_task(self, task, written):
+        kind, what, params, future = task
+        if not future.set_running_or_notify_cancel():
+            return
+        if kind != READ:
+            # Each write gets a savepoint in the tick's transaction, so one that fails
+            # halfway leaves nothing behind for the commit.
+            if not self.connection.connection.in_transaction:
+                self.connection.db_query("BEGIN")
+            self.connection.db_query("SAVEPOINT task")
+        try:
+            if kind == READ:
+                future.set_result(timed("executor", what, lambda: self.connection.db_query(what, *params).fetchall()))
+            elif kind == WRITE:
+                written.append((future, timed("executor", what, self.connection.db_query, what, *params).rowcount))
+            elif kind == WRITE_MANY:
+                written.append((future, timed("executor", what, self.connection.db_querymany, what, *params).rowcount))
+            elif kind == CALL:
+                written.append((future, timed("executor", what.__name__, what, self.connection, *params)))
+            if kind != READ:
+                self.end_task(rollback=False)
+        except Exception as e:
+            if kind != READ:
+                self.end_task(rollback=True)
+            future.set_exception(e)
+
+    def end_task(self, rollback):
+        """Release the task's savepoint, rolling back to it first if it failed."""
+        # A task that committed or rolled back on its own took the savepoint with it.
+        if not self.connection.connection.in_transaction:
+            return
+        try:
+            if rollback:
+                self.connection.db_query("ROLLBACK TO task")
+            self.connection.db_query("RELEASE task")
+        except sqlite3.Error:
+            pass
+
+    def commit(self, written):
+        try:
+            self.connection.db_commit()
+            self.commits += 1
+        except Exception as e:
+            # Don't leave the failed transaction open for the next tick to commit.
+            try:
+                self.connection.connection.rollback()
+            except sqlite3.Error:
+                pass
+            for future, result in written:
+                future.set_exception(e)
+            return
+        for future, result in written:
+            future.set_result(result)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor(config=None):
+    """Get the shared executor, starting it on first use with the [Core] DatabasePath
+    and the [Database] profile from the config.
+
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None or not _executor.is_alive():
+            if config is None:
+                import minqlbot
+                config = minqlbot.get_config()
+            _executor = Executor(database_path(config), database_profile(config))
+            _executor.start()
+            _executor.ready.wait()
+            if _executor.error:
+                error = _executor.error
+                _executor = None
+                raise error
+        return _executor
+
+def stop_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.stop()
+            _executor = None
+
+if __name__ == "__main__":
+    # Usage: executor.py -- checks that a write failing halfway leaves nothing behind
+    # while the other writes of the same tick are still committed, and that a call ending
+    # the transaction on its own doesn't take the executor down.
+    import os
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "check.db")
+    executor = Executor(path)
+    executor.start()
+    executor.ready.wait()
+
+    def fails_halfway(db):
+        db.db_query("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) "
+            "VALUES('halfway', 0, '', 0, 0)")
+        raise ValueError("Failing on purpose.")
+
+    failed = executor.call(fails_halfway)
+    kept = executor.execute("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) "
+        "VALUES('kept', 0, '', 0, 0)")
+    assert isinstance(failed.exception(), ValueError)
+    assert kept.result() == 1
+    names = [row["name"] for row in executor.query("SELECT name FROM Players").result()]
+
+    def rolls_back(db):
+        db.db_query("ROLLBACK")
+        raise ValueError("Failing on purpose.")
+
+    assert isinstance(executor.call(rolls_back).exception(), ValueError)
+    assert executor.call(lambda db: db.db_query("COMMIT")).exception() is None
+    assert executor.is_alive()
+    executor.stop()
+    os.remove(path)
+    os.rmdir(folder)
+    assert names == ["kept"], names
+    print("A failed call left nothing behind, and the executor survived ending its transaction.")
@@ -0,0 +1,81 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Pruning of players we haven't seen in a long time, and incremental vacuuming.
+
+These are meant to be run on the database thread with Executor.call(), one batch at a
+time, so other plugins' writes get a turn in between. The exception is switching on
+incremental vacuuming in the first place, which takes a full VACUUM on a connection of
+its own.
+"""
+
+import sqlite3
+
+# How long, in milliseconds, the VACUUM waits for the executor to finish a commit.
+VACUUM_BUSY_TIMEOUT = 30000
+
+def auto_vacuum_pending(db):
+    """Whether incremental vacuuming still has to be switched on with enable_auto_vacuum."""
+    return db.db_query("PRAGMA auto_vacuum").fetchone()[0] != 2
+
+def enable_auto_vacuum(path):
+    """Switch on incremental vacuuming with a full VACUUM, which can't run in a
+    transaction and so can't go through the executor. It rewrites the whole file, and
+    writes wait until it's done.
+
+    """
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute("PRAGMA busy_timeout={}".format(VACUUM_BUSY_TIMEOUT))
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("VACUUM")
+    finally:
+        db.close()
+
+def prune_players(db, before, batch_size):
+    """Delete up to batch_size players last seen before the given DATETIME_FORMAT string
+    who have no permission, rating, alias, ban history or leaves. Leaver bans are worked
+    out from games_left rather than a Bans row, and banned leavers get kicked before
+    their last_seen is ever updated, so anyone with leaves is kept. Players who have
+    never been seen are left alone, since we can't tell how old they are. Returns how
+    many were deleted.
+
+    """
+    if batch_size < 1:
+        # LIMIT 0 deletes nothing and a negative one everything, so callers would never finish.
+        raise ValueError("batch_size must be at least 1.")
+    c = db.db_query("SELECT name FROM Players WHERE last_seen!='' AND last_seen<? AND permission=0 "
+        "AND games_left=0 "
+        "AND NOT EXISTS (SELECT 1 FROM Ratings WHERE Ratings.name=Players.name) "
+        "AND NOT EXISTS (SELECT 1 FROM Aliases WHERE Aliases.name=Players.name) "
+        "AND NOT EXISTS (SELECT 1 FROM Bans WHERE Bans.name=Players.name) "
+        "LIMIT ?", before, batch_size)
+    names = [(row[0],) for row in c.fetchall()]
+    if not names:
+        return 0
+    db.db_querymany("DELETE FROM Players WHERE name=?", *names)
+    return len(names)
+
+def incremental_vacuum(db, pages):
+    """Give up to pages free pages back to the file system. Returns the free pages left."""
+    if pages < 1:
+        # SQLite takes 0 or less to mean all of them, in one go.
+        raise ValueError("pages must be at least 1.")
+    # The pragma does its work as its rows are stepped through.
+    db.db_query("PRAGMA incremental_vacuum({})".format(int(pages))).fetchall()
+    return db.db_query("PRAGMA freelist_count").fetchone()[0]
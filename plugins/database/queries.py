@@ -0,0 +1,37 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""SQL for the queries the plugins run on hot paths, like on every connect. The plugins
+use these as they are, so what the query plan check in database.py runs is exactly
+what they do.
+"""
+
+PLAYER = "SELECT * FROM Players WHERE name=?"
+LAST_SEEN = "SELECT last_seen FROM Players WHERE name=?"
+UPDATE_LAST_SEEN = "UPDATE Players SET last_seen=? WHERE name=?"
+# The player and their main account. Without statistics, SQLite would rather pick the
+# (active, expires) index meant for the sweep, which walks every active ban.
+ACTIVE_BAN = ("SELECT expires, reason FROM Bans INDEXED BY Bans_name_active_expires "
+    "WHERE name IN (?, ?) AND active=1 AND expires>? ORDER BY expires DESC LIMIT 1")
+SWEEP_BANS = ("UPDATE Bans SET active=0 WHERE rowid IN "
+    "(SELECT rowid FROM Bans WHERE active=1 AND expires<=? LIMIT ?)")
+RATINGS = "SELECT game_type, rating FROM Ratings WHERE name=?"
+RATING = "SELECT rating FROM Ratings WHERE name=? AND game_type=?"
+CURRENT_MOTD = "SELECT message FROM Motd ORDER BY time DESC LIMIT 1"
+LEAVERS = ("SELECT name, games_completed, games_left, completion_ratio FROM Players "
+    "WHERE completion_ratio<=? ORDER BY completion_ratio LIMIT ? OFFSET ?")
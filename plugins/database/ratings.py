@@ -0,0 +1,104 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk import and export of the Ratings table as CSV or JSON lines.
+
+Both formats have the fields name, game_type and rating. CSV files may start with a
+header line with those names. The format is picked by the file extension: .jsonl
+(or .json) for JSON lines, anything else is treated as CSV. Files are streamed, so
+their size doesn't matter. Run these on the database thread with Executor.call().
+"""
+
+import itertools
+import json
+import csv
+
+CHUNK_SIZE = 1000
+FIELDS = ("name", "game_type", "rating")
+
+def is_jsonl(path):
+    return path.lower().endswith((".jsonl", ".json"))
+
+def read_ratings(f, jsonl):
+    """Yield (name, game_type, rating) tuples from a file, and None for lines we can't use."""
+    if jsonl:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                d = json.loads(line)
+                yield clean(d["name"], d["game_type"], d["rating"])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                yield None
+    else:
+        for row in csv.reader(f):
+            if not row or [c.strip().lower() for c in row] == list(FIELDS):
+                continue
+            try:
+                yield clean(*row)
+            except (ValueError, TypeError, AttributeError):
+                yield None
+
+def clean(name, game_type, rating):
+    name = name.strip().lower()
+    game_type = game_type.strip().lower()
+    if not name or not game_type:
+        raise ValueError("Empty name or game type.")
+    return name, game_type, int(rating)
+
+def import_ratings(db, path):
+    """Import ratings from a file in a single transaction, adding players we don't
+    know. Returns (imported, skipped, {(name, game_type), ...}).
+
+    """
+    imported = 0
+    skipped = 0
+    changed = set()
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = read_ratings(f, is_jsonl(path))
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            good = [r for r in chunk if r is not None]
+            skipped += len(chunk) - len(good)
+            if not good:
+                continue
+            db.db_querymany("INSERT OR IGNORE INTO Players(name, permission, last_seen, games_completed, games_left) "
+                "VALUES(?, 0, '', 0, 0)", *[(r[0],) for r in good])
+            db.db_querymany("INSERT OR REPLACE INTO Ratings VALUES(?, ?, ?)", *good)
+            imported += len(good)
+            changed.update((r[0], r[1]) for r in good)
+    return imported, skipped, changed
+
+def export_ratings(db, path):
+    """Write every rating to a file. Returns how many were written."""
+    count = 0
+    jsonl = is_jsonl(path)
+    c = db.db_query("SELECT name, game_type, rating FROM Ratings ORDER BY name, game_type")
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if not jsonl:
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+        for row in c:
+            if jsonl:
+                f.write(json.dumps(dict(zip(FIELDS, tuple(row)))) + "\n")
+            else:
+                writer.writerow(tuple(row))
+            count += 1
+    return count
@@ -0,0 +1,128 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-query timing, grouped by plugin and normalized statement.
+
+install() wraps db_query and db_querymany on the plugin base class, so every plugin's
+queries are timed without touching the plugins themselves. The database executor
+records its queries here too, under the name "executor".
+"""
+
+from collections import deque
+import threading
+import time
+import re
+
+# How many timings we keep per statement for the percentiles.
+SAMPLES = 1024
+SLOW_LOG_SIZE = 50
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+WHITESPACE = re.compile(r"\s+")
+
+def normalize(query):
+    """Replace literals with ? and collapse whitespace, so the same statement with
+    different values is counted as one. Identifiers are left as they are.
+
+    """
+    query = STRING_LITERAL.sub("?", query)
+    query = NUMBER_LITERAL.sub("?", query)
+    return WHITESPACE.sub(" ", query).strip()
+
+class StatementStats():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(len(s) * p / 100))]
+
+class QueryStats():
+    def __init__(self, threshold=0.05):
+        # In seconds. Queries slower than this go to the slow query log.
+        self.threshold = threshold
+        self.statements = {}
+        self.slow = deque(maxlen=SLOW_LOG_SIZE)
+        self.lock = threading.Lock()
+        self.on_slow = None
+
+    def record(self, plugin, query, elapsed):
+        key = (plugin, normalize(query))
+        with self.lock:
+            if key not in self.statements:
+                self.statements[key] = StatementStats()
+            stats = self.statements[key]
+            stats.count += 1
+            stats.total += elapsed
+            stats.samples.append(elapsed)
+            is_slow = elapsed >= self.threshold
+            if is_slow:
+                self.slow.append((time.time(), plugin, query, elapsed))
+        if is_slow and self.on_slow:
+            self.on_slow(plugin, query, elapsed)
+
+    def top(self, n=5):
+        """The n statements with the most total time as
+        (plugin, statement, count, total, p50, p95, p99) tuples.
+
+        """
+        with self.lock:
+            items = sorted(self.statements.items(), key=lambda i: i[1].total, reverse=True)[:n]
+            return [(plugin, statement, s.count, s.total, s.percentile(50), s.percentile(95), s.percentile(99))
+                    for (plugin, statement), s in items]
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.slow.clear()
+
+STATS = QueryStats()
+_originals = {}
+
+def timed(plugin, query, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        STATS.record(plugin, query, time.perf_counter() - start)
+
+def install(plugin_class):
+    """Wrap db_query and db_querymany on plugin_class with timing."""
+    if _originals:
+        return
+    for name in ("db_query", "db_querymany"):
+        original = getattr(plugin_class, name)
+        _originals[name] = original
+        def wrapper(self, query, *params, original=original):
+            return timed(self.__class__.__name__, query, original, self, query, *params)
+        wrapper.__doc__ = original.__doc__
+        setattr(plugin_class, name, wrapper)
+    _originals["class"] = plugin_class
+
+def uninstall():
+    if not _originals:
+        return
+    plugin_class = _originals.pop("class")
+    for name, original in _originals.items():
+        setattr(plugin_class, name, original)
+    _originals.clear()
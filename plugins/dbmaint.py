@@ -0,0 +1,196 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Database maintenance: online backups, pruning of long gone players and incremental
+vacuuming, on a schedule or on demand."""
+
+import minqlbot
+import threading
+import traceback
+import datetime
+import os
+import plugins.database as database
+import plugins.settings as settings
+import plugins.scheduler as scheduler
+from plugins.settings import Setting
+
+BACKUP_FOLDER = "python\\backups"
+BACKUP_INTERVAL = 24
+BACKUP_KEEP = 7
+MAINTENANCE_INTERVAL = 24
+PRUNE_AFTER_DAYS = 180
+PRUNE_BATCH_SIZE = 500
+VACUUM_PAGES = 1000
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def positive_int(value):
+    # Batches of 0 or less would mean no limit, or to SQLite a batch that never ends.
+    value = int(value)
+    if value < 1:
+        raise ValueError("Must be at least 1.")
+    return value
+
+SETTINGS = (
+    Setting("backup_folder", "BackupFolder", str, BACKUP_FOLDER),
+    Setting("backup_interval", "BackupInterval", float, BACKUP_INTERVAL),
+    Setting("backup_keep", "BackupKeep", int, BACKUP_KEEP),
+    Setting("maintenance_interval", "MaintenanceInterval", float, MAINTENANCE_INTERVAL),
+    Setting("prune_after_days", "PruneAfterDays", int, PRUNE_AFTER_DAYS),
+    Setting("prune_batch_size", "PruneBatchSize", positive_int, PRUNE_BATCH_SIZE),
+    Setting("vacuum_pages", "VacuumPages", positive_int, VACUUM_PAGES),
+    )
+
+class dbmaint(minqlbot.Plugin):
+    def __init__(self):
+        super().__init__()
+        settings.register(self, "DbMaint", SETTINGS)
+        self.add_hook("unload", self.handle_unload)
+        self.add_command("backup", self.cmd_backup, 5, usage="[list]")
+        self.add_command("maintenance", self.cmd_maintenance, 5)
+
+        self.backup_lock = threading.Lock()
+        self.backup_timer = None
+        self.maintenance_lock = threading.Lock()
+        self.maintenance_timer = None
+        self.unloaded = False
+        self.schedule_backup()
+        self.schedule_maintenance()
+
+    def handle_unload(self):
+        self.unloaded = True
+        settings.unregister(self)
+        if self.backup_timer:
+            self.backup_timer.cancel()
+        if self.maintenance_timer:
+            self.maintenance_timer.cancel()
+
+    def cmd_backup(self, player, msg, channel):
+        if len(msg) > 1 and msg[1].lower() == "list":
+            backups = database.list_backups(self.settings.backup_folder)
+            if not backups:
+                channel.reply("^7There are no backups.")
+            else:
+                channel.reply("^7{} backup(s), newest: ^6{}".format(len(backups), os.path.basename(backups[-1])))
+            return
+
+        if self.backup_lock.locked():
+            channel.reply("^7A backup is already running.")
+            return
+        channel.reply("^7Starting backup...")
+        threading.Thread(target=self.run_backup, args=(channel,)).start()
+
+    def cmd_maintenance(self, player, msg, channel):
+        if self.maintenance_lock.locked():
+            channel.reply("^7Maintenance is already running.")
+            return
+        channel.reply("^7Starting database maintenance...")
+        threading.Thread(target=self.run_maintenance, args=(channel,)).start()
+
+    def run_backup(self, channel=None):
+        """Back up the database. Runs on its own thread."""
+        if not self.backup_lock.acquire(blocking=False):
+            return
+        try:
+            folder = self.settings.backup_folder
+            reported = [0]
+
+            def progress(copied, total):
+                # Report every quarter of the way.
+                if total and copied * 4 // total > reported[0]:
+                    reported[0] = copied * 4 // total
+                    self.debug("Backup: {}/{} pages copied.".format(copied, total))
+
+            path, pages, seconds = database.backup(database.database_path(minqlbot.get_config()), folder, progress=progress)
+            removed = database.prune_backups(folder, self.settings.backup_keep, path)
+            report = "^7Backup ^6{}^7 done: ^6{}^7 pages in ^6{}^7 seconds. Removed ^6{}^7 old backup(s).".format(
+                os.path.basename(path), pages, round(seconds, 2), len(removed))
+            self.debug(report)
+            if channel:
+                channel.reply(report)
+        except Exception as e:
+            if channel:
+                channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
+            minqlbot.debug("========== ERROR: {}@run_backup ==========".format(self.__class__.__name__))
+            for line in traceback.format_exc().rstrip("\n").split("\n"):
+                minqlbot.debug(line)
+        finally:
+            self.backup_lock.release()
+
+    def schedule_backup(self):
+        hours = self.settings.backup_interval
+        if hours > 0 and not self.unloaded:
+            self.backup_timer = scheduler.schedule(hours * 3600, self.scheduled_backup, thread=True)
+
+    def scheduled_backup(self):
+        try:
+            self.run_backup()
+        finally:
+            self.schedule_backup()
+
+    def run_maintenance(self, channel=None):
+        """Prune players and vacuum in bounded batches. Runs on its own thread, and each
+        batch is its own transaction on the database thread.
+
+        """
+        if not self.maintenance_lock.acquire(blocking=False):
+            return
+        try:
+            executor = database.get_executor()
+            days = self.settings.prune_after_days
+            batch_size = self.settings.prune_batch_size
+            pruned = 0
+            if days > 0:
+                before = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime(DATETIME_FORMAT)
+                while not self.unloaded:
+                    count = executor.call(database.prune_players, before, batch_size).result()
+                    pruned += count
+                    if not count or count < batch_size:
+                        break
+
+            if executor.call(database.auto_vacuum_pending).result():
+                if channel:
+                    channel.reply("^7Switching on incremental vacuuming. This rewrites the database once...")
+                    database.enable_auto_vacuum(database.database_path(minqlbot.get_config()))
+                else:
+                    self.debug("Incremental vacuuming is off until !maintenance switches it on.")
+
+            pages = self.settings.vacuum_pages
+            free = executor.call(database.incremental_vacuum, pages).result()
+            report = "^7Maintenance done: pruned ^6{}^7 player(s), ^6{}^7 free page(s) left.".format(pruned, free)
+            self.debug(report)
+            if channel:
+                channel.reply(report)
+        except Exception as e:
+            if channel:
+                channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
+            minqlbot.debug("========== ERROR: {}@run_maintenance ==========".format(self.__class__.__name__))
+            for line in traceback.format_exc().rstrip("\n").split("\n"):
+                minqlbot.debug(line)
+        finally:
+            self.maintenance_lock.release()
+
+    def schedule_maintenance(self):
+        hours = self.settings.maintenance_interval
+        if hours > 0 and not self.unloaded:
+            self.maintenance_timer = scheduler.schedule(hours * 3600, self.scheduled_maintenance, thread=True)
+
+    def scheduled_maintenance(self):
+        try:
+            self.run_maintenance()
+        finally:
+            self.schedule_maintenance()
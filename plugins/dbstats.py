@@ -0,0 +1,87 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Times every plugin's database queries and logs the slow ones."""
+
+import minqlbot
+import time
+import plugins.database as database
+import plugins.settings as settings
+from plugins.settings import Setting
+
+# Every statement is a line of chat, so don't let anyone flood it.
+MAX_COUNT = 10
+
+SETTINGS = (
+    Setting("slow_query_threshold", "SlowQueryThreshold", int, 50),
+    )
+
+class dbstats(minqlbot.Plugin):
+    def __init__(self):
+        super().__init__()
+        settings.register(self, "DbStats", SETTINGS, on_reload=self.apply_settings)
+        self.add_hook("unload", self.handle_unload)
+        self.add_command("dbstats", self.cmd_dbstats, 5, usage="[count|slow|reset]")
+
+        self.apply_settings()
+        database.STATS.on_slow = self.log_slow_query
+        database.install_stats(minqlbot.Plugin)
+
+    def handle_unload(self):
+        settings.unregister(self)
+        database.uninstall_stats()
+        database.STATS.on_slow = None
+
+    def apply_settings(self):
+        database.STATS.threshold = self.settings.slow_query_threshold / 1000
+
+    def cmd_dbstats(self, player, msg, channel):
+        if len(msg) > 1 and msg[1].lower() == "reset":
+            database.STATS.reset()
+            channel.reply("^7Query statistics have been reset.")
+            return
+        elif len(msg) > 1 and msg[1].lower() == "slow":
+            with database.STATS.lock:
+                slow = list(database.STATS.slow)[-5:]
+            if not slow:
+                channel.reply("^7No slow queries so far.")
+            for when, plugin, query, elapsed in reversed(slow):
+                channel.reply("^7{} ^6{}^7 {}ms: {}".format(time.strftime("%H:%M:%S", time.localtime(when)),
+                    plugin, round(elapsed * 1000, 1), database.normalize(query)))
+            return
+
+        count = 5
+        if len(msg) > 1:
+            try:
+                count = int(msg[1])
+            except ValueError:
+                return minqlbot.RET_USAGE
+            if count < 1:
+                return minqlbot.RET_USAGE
+            count = min(count, MAX_COUNT)
+
+        top = database.STATS.top(count)
+        if not top:
+            channel.reply("^7No queries have been timed yet.")
+            return
+        for plugin, statement, n, total, p50, p95, p99 in top:
+            channel.reply("^6{}^7: {}x, {}ms total, p50/p95/p99 {}/{}/{}ms: {}".format(plugin, n,
+                round(total * 1000, 1), round(p50 * 1000, 2), round(p95 * 1000, 2), round(p99 * 1000, 2), statement))
+
+    def log_slow_query(self, plugin, query, elapsed):
+        self.debug("SLOW QUERY ({}ms) from {}: {}".format(round(elapsed * 1000, 1), plugin, database.normalize(query)))
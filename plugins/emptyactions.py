@@ -21,35 +21,43 @@
 import minqlbot
 import random
 
+import plugins.settings as settings
+import plugins.roster as roster
+import plugins.scheduler as scheduler
+from plugins.settings import Setting
+
+SETTINGS = (
+    Setting("teamsize_on_empty", "TSOnEmpty", int, 0),
+    Setting("maps_on_empty", "MapOnEmpty", list, ()),
+    )
+
 class emptyactions(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        settings.register(self, "EmptyActions", SETTINGS)
+        self.add_hook("unload", self.handle_unload)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
 
+    def handle_unload(self):
+        settings.unregister(self)
+        scheduler.cancel("emptyactions.change_map")
+
     def handle_player_disconnect(self, player, reason):
-        teams = self.teams()
-        count = len(teams["red"]) + len(teams["blue"]) + len(teams["spectator"])
+        count = roster.get_roster().count("red", "blue", "spectator")
         
         if (count < 2):
-            config = minqlbot.get_config()
-            new_ts = 0
-            if "EmptyActions" in config and "TSOnEmpty" in config["EmptyActions"]:
-                new_ts = int(config["EmptyActions"]["TSOnEmpty"])
+            new_ts = self.settings.teamsize_on_empty
             if (new_ts > 0 and new_ts <= 8):
                 self.teamsize(new_ts)
-                self.delay(5, self.change_map)
+                scheduler.schedule(5, self.change_map, key="emptyactions.change_map")
             else:
                 self.change_map()
         
     def change_map(self):
-        config = minqlbot.get_config()
         new_map = ""
-        if "EmptyActions" in config and "MapOnEmpty" in config["EmptyActions"]:
-            try:
-                new_map = random.choice([s.strip() for s in config["EmptyActions"]["MapOnEmpty"].split(",")])
-            except IndexError:
-                return
-            
+        if self.settings.maps_on_empty:
+            new_map = random.choice(self.settings.maps_on_empty)
+
         if new_map != "":
             self.change_map(new_map)
         
\ No newline at end of file
@@ -20,19 +20,100 @@
 
 import minqlbot
 import datetime
+import threading
+import sqlite3
+import time
 import re
 
+import plugins.database as database
+import plugins.aliasindex as aliasindex
+import plugins.settings as settings
+import plugins.events as events
+import plugins.playerkeys as playerkeys
+import plugins.roster as roster
+import plugins.scheduler as scheduler
+from plugins.settings import Setting
+
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 TIME_FORMAT = "%H:%M:%S"
+SEEN_FLUSH_INTERVAL = 60
+DB_ROW_CAP = 20
+DB_TIMEOUT = 2.0
+# SQLite VM instructions between timeout checks.
+DB_PROGRESS_STEPS = 10000
+# Reply line lengths for !db, by channel name.
+DB_REPLY_LENGTH = {"irc": 450, None: 150}
+# Statements !db won't run, since the database thread owns the transaction.
+TRANSACTION_CONTROL = re.compile(r"^\s*(begin|commit|end|rollback|savepoint|release)\b", re.IGNORECASE)
+# Configstrings the server updates the vote tally through.
+CS_VOTE_YES = 10
+CS_VOTE_NO = 11
+VOTE_CS_REGEX = re.compile(r'^cs (?P<index>1[01]) "(?P<count>[0-9]+)"')
+# Seconds into a vote the fallback resolve happens if the tally never settled it.
+VOTE_RESOLVE_DELAY = 27.5
+
+SETTINGS = (
+    Setting("auto_pass_majority_vote", "AutoPassMajorityVote", bool, False),
+    Setting("maximum_teamsize", "MaximumTeamsize", int, None),
+    Setting("minimum_teamsize", "MinimumTeamsize", int, None),
+    Setting("db_row_cap", "DbRowCap", int, DB_ROW_CAP),
+    Setting("db_timeout", "DbTimeout", float, DB_TIMEOUT),
+    Setting("seen_flush_interval", "SeenFlushInterval", int, SEEN_FLUSH_INTERVAL),
+    )
+
+def write_seen(db, pending):
+    """Runs on the database thread, so all of it is committed at once."""
+    db.db_querymany("INSERT OR IGNORE INTO Players(name, permission, last_seen, games_completed, games_left) "
+        "VALUES(?, 0, ?, 0, 0)", *pending)
+    db.db_querymany(database.queries.UPDATE_LAST_SEEN, *[(t, n) for n, t in pending])
+
+def run_db_query(db, query, offset, row_cap, timeout):
+    """Runs an admin's !db query on the database thread, aborting it after a while.
+    Returns (columns, rows, rowcount, paged). Selects are paged, so rows holds at most
+    row_cap + 1 of them from offset on, and paged is True. Anything else is run once and
+    all its rows are returned, if it has any, since running a write again to get the
+    next page would write twice. columns is None for statements without rows, and
+    rowcount is how many rows were changed.
+
+    """
+    if TRANSACTION_CONTROL.match(query):
+        # The database thread commits on its own, and ending its transaction halfway
+        # through a tick would take other plugins' writes with it.
+        raise ValueError("Transactions are handled by the bot. Run the statements on their own.")
+    deadline = time.time() + timeout
+    db.connection.set_progress_handler(lambda: time.time() > deadline, DB_PROGRESS_STEPS)
+    try:
+        try:
+            # Only a statement that just reads can be a subquery, so SQLite refuses to
+            # even start anything else like this. Fetch one row more than we show to
+            # know if there are more.
+            c = db.db_query("SELECT * FROM ({}) LIMIT ? OFFSET ?".format(query), row_cap + 1, offset)
+            return [d[0] for d in c.description], c.fetchall(), 0, True
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                raise
+
+        # PRAGMA, writes with RETURNING and whatever else there is.
+        changes = db.connection.total_changes
+        c = db.db_query(query)
+        rows = c.fetchall()
+        columns = [d[0] for d in c.description] if c.description else None
+        return columns, rows if columns else None, db.connection.total_changes - changes, False
+    finally:
+        db.connection.set_progress_handler(None, 0)
 
 class essentials(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        settings.register(self, "Essentials", SETTINGS)
+        self.add_hook("unload", self.handle_unload)
         self.add_hook("player_connect", self.handle_player_connect)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("bot_connect", self.handle_bot_connect)
+        self.add_hook("game_end", self.handle_game_end)
         self.add_hook("vote_called", self.handle_vote_called)
         self.add_hook("vote_ended", self.handle_vote_ended)
+        self.add_hook("raw", self.handle_raw)
         self.add_command("kick", self.cmd_kick, 2, usage="<name>")
         self.add_command("kickban", self.cmd_kickban, 2, usage="<name>")
         self.add_command("yes", self.cmd_yes, 2)
@@ -55,13 +136,39 @@ class essentials(minqlbot.Plugin):
         self.add_command("map", self.cmd_map, 2, usage="<mapname>")
         self.add_command("opsay", self.cmd_opsay, 3, usage="<message>")
         self.add_command(("help", "about", "commands"), self.cmd_help)
-        self.add_command("db", self.cmd_db, 5, usage="<query>")
+        self.add_command("db", self.cmd_db, 5, usage="<query> | more")
         self.add_command("seen", self.cmd_seen, usage="<full_name>")
         self.add_command("time", self.cmd_time, usage="[timezone_offset]")
         self.add_command(("teamsize", "ts"), self.cmd_teamsize, 2, usage="<size>")
         self.add_command("exit", self.cmd_exit, 5)
 
         self.vote_resolve_timer = None
+        # [yes, no] of the current vote, kept up to date from the raw configstrings.
+        self.vote_tally = None
+        self.vote_resolved = False
+        self.vote_lock = threading.Lock()
+        # Keys: lowercase clean name - Items: (query, offset, columns, rows) for !db more,
+        # where columns and rows are the rest of a query that isn't paged, else None.
+        self.db_cursors = {}
+
+        # Keys: lowercase clean name - Items: last_seen timestamp not yet written to the database.
+        self.seen = {}
+        # Entries handed to the database thread but not yet committed.
+        self.flushing = {}
+        self.seen_lock = threading.Lock()
+        self.flush_timer = None
+        self.unloaded = False
+        self.schedule_flush()
+
+    def handle_unload(self):
+        self.unloaded = True
+        settings.unregister(self)
+        if self.flush_timer:
+            self.flush_timer.cancel()
+        scheduler.cancel("essentials.resolve_vote")
+        pending = self.flush_seen()
+        if pending:
+            pending.result()
 
     def handle_player_connect(self, player):
         self.update_player(player)
@@ -76,25 +183,29 @@ class essentials(minqlbot.Plugin):
         for player in self.players():
             self.update_player(player)
 
+    def handle_game_end(self, game, score, winner):
+        self.flush_seen()
+
     def handle_vote_called(self, caller, vote, args):
-        config = minqlbot.get_config()
-        if "Essentials" in config and "AutoPassMajorityVote" in config["Essentials"]:
-            auto_pass = config["Essentials"].getboolean("AutoPassMajorityVote")
-            if auto_pass:
-                self.vote_resolve_timer = self.delay(27.5, self.resolve_vote)
+        conf = self.settings
+        # The caller's own vote might already be in.
+        votes = self.current_vote_count()
+        with self.vote_lock:
+            self.vote_tally = list(votes) if votes else [0, 0]
+            self.vote_resolved = False
+        if conf.auto_pass_majority_vote:
+            # Only a fallback now, in case the tally never settles it before the end.
+            self.vote_resolve_timer = scheduler.schedule(VOTE_RESOLVE_DELAY, self.resolve_vote,
+                key="essentials.resolve_vote")
 
         # Enforce teamsizes.
         if vote == "teamsize":
             args = int(args)
-            if "Essentials" in config and "MaximumTeamsize" in config["Essentials"]:
-                max_teamsize = int(config["Essentials"]["MaximumTeamsize"])
-                if args > max_teamsize:
-                    self.vote_no()
-
-            if "Essentials" in config and "MinimumTeamsize" in config["Essentials"]:
-                min_teamsize = int(config["Essentials"]["MinimumTeamsize"])
-                if args < min_teamsize:
-                    self.vote_no()
+            if conf.maximum_teamsize is not None and args > conf.maximum_teamsize:
+                self.vote_no()
+
+            if conf.minimum_teamsize is not None and args < conf.minimum_teamsize:
+                self.vote_no()
         elif vote == "kick":
             if args == minqlbot.NAME.lower():
                 self.vote_no()
@@ -102,30 +213,86 @@ class essentials(minqlbot.Plugin):
     def handle_vote_ended(self, vote, args, vote_count, passed):
         if self.vote_resolve_timer and self.vote_resolve_timer.is_alive():
             self.vote_resolve_timer.cancel()
+        with self.vote_lock:
+            self.vote_tally = None
 
         if passed == None: # Vote was cancelled.
             self.msg("^7RIP vote.")
 
+    def handle_raw(self, cmd):
+        if not cmd.startswith("cs 1"):
+            return
+        r = VOTE_CS_REGEX.match(cmd)
+        if not r:
+            return
+        with self.vote_lock:
+            if self.vote_tally is None:
+                return
+            self.vote_tally[int(r.group("index")) - CS_VOTE_YES] = int(r.group("count"))
+        if self.settings.auto_pass_majority_vote:
+            self.check_vote_settled()
+
+    def check_vote_settled(self):
+        """Pass the vote as soon as everyone who hasn't voted yet voting no couldn't
+        take the majority away from yes, and stop waiting if yes can't get it anymore.
+
+        """
+        voters = roster.get_roster().count()
+        with self.vote_lock:
+            if self.vote_tally is None or self.vote_resolved:
+                return
+            yes, no = self.vote_tally
+            remaining = max(0, voters - yes - no)
+            if yes > no + remaining:
+                self.vote_resolved = True
+            elif no >= yes + remaining:
+                # Yes can't win a majority, so there's nothing left to do.
+                self.vote_resolved = True
+                yes = None
+            else:
+                return
+
+        if self.vote_resolve_timer and self.vote_resolve_timer.is_alive():
+            self.vote_resolve_timer.cancel()
+        if yes is not None:
+            self.vote_yes()
+            self.msg("^7Result: ^6{}^7 - {}".format(yes, no))
+
+    def target(self, name, channel):
+        """Resolve a full or partial name to a connected player, telling the channel
+        if we don't know it or it could be more than one player.
+
+        """
+        matches = roster.get_roster().find(name)
+        if len(matches) == 1:
+            return matches[0]
+        elif len(matches) > 1:
+            channel.reply("^7'{}' could be any of: ^6{}^7. Be more specific."
+                .format(name, "^7, ^6".join(p.clean_name for p in matches)))
+            return None
+
+        # Not the start of anyone's name, but the core also matches anywhere in it.
+        n = self.find_player(name)
+        if not n:
+            channel.reply("^7I do not know '{}'.".format(name))
+        return n
+
     def cmd_kick(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             if not self.kick(n):
                 channel.reply("^7Try again after the current vote.")
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_kickban(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.kickban(n)
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_yes(self, player, msg, channel):
         if self.is_vote_active():
@@ -143,47 +310,35 @@ class essentials(minqlbot.Plugin):
         if len(msg) < 3:
             return minqlbot.RET_USAGE
 
-        n1 = self.find_player(msg[1])
-        n2 = self.find_player(msg[2])
+        n1 = self.target(msg[1], channel)
+        n2 = self.target(msg[2], channel)
         if n1 and n2:
             if not self.switch(n1, n2):
                 channel.reply("^7I can't switch those players.")
-        elif n1 and not n2:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
-        elif n2 and not n1:
-            channel.reply("^7I do not know '{}'.".format(msg[2]))
-        else:
-            channel.reply("^7I do not know '{}' nor '{}'.".format(msg[1], msg[2]))
             
     def cmd_red(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.put(n, "red")
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_blue(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.put(n, "blue")
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_spectate(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.put(n, "spectator")
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
         
     def cmd_opme(self, player, msg, channel):
         self.op(player)
@@ -195,41 +350,33 @@ class essentials(minqlbot.Plugin):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.op(n)
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_deop(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.deop(n)
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_mute(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.mute(n)
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
 
     def cmd_unmute(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
 
-        n = self.find_player(msg[1])
+        n = self.target(msg[1], channel)
         if n:
             self.unmute(n)
-        else:
-            channel.reply("^7I do not know '{}'.".format(msg[1]))
     
     def cmd_allready(self, player, msg, channel):
         if self.game().state == "warmup":
@@ -276,23 +423,80 @@ class essentials(minqlbot.Plugin):
     def cmd_db(self, player, msg, channel):
         if len(msg) == 1:
             return minqlbot.RET_USAGE
-        
-        try:
-            query = " ".join(msg[1:])
-            c = self.db_query(query)
-            self.db_commit()
-            columns_printed = False
-            for row in c:
-                if not columns_printed:
-                    channel.reply("^7{}".format(row.keys()))
-                    columns_printed = True
-                channel.reply("^7{}".format(tuple(row)))
-
-            if not columns_printed and query.lower().startswith("select"):
-                channel.reply("^7Your query yielded no results.")
-        except Exception as e:
-            channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
-            raise
+
+        key = playerkeys.key(player)
+        if len(msg) == 2 and msg[1].lower() == "more":
+            if key not in self.db_cursors:
+                channel.reply("^7There are no more rows.")
+                return
+            query, offset, columns, rows = self.db_cursors.pop(key)
+            if rows is not None:
+                self.show_db_rows(key, query, columns, rows, offset, self.settings.db_row_cap, False, channel)
+                return
+        else:
+            query = " ".join(msg[1:]).strip().rstrip(";")
+            offset = 0
+
+        row_cap = self.settings.db_row_cap
+        timeout = self.settings.db_timeout
+
+        # Run it on the database thread and reply when it's done, so we don't hold up anything.
+        future = database.get_executor().call(run_db_query, query, offset, row_cap, timeout)
+        future.add_done_callback(lambda f: self.reply_db(f, key, query, offset, row_cap, channel))
+
+    def reply_db(self, future, key, query, offset, row_cap, channel):
+        e = future.exception()
+        if e:
+            if isinstance(e, sqlite3.OperationalError) and str(e) == "interrupted":
+                channel.reply("^1Timeout^7: The query took too long and was aborted.")
+            else:
+                channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
+            return
+
+        columns, rows, rowcount, paged = future.result()
+        if columns is None or rowcount:
+            # The query could have changed anything, so let everyone drop what they cached.
+            for event in events.DATA_EVENTS:
+                events.publish(event)
+        if columns is None:
+            channel.reply("^7Done. ^6{}^7 row(s) affected.".format(max(rowcount, 0)))
+            return
+        elif not rows:
+            channel.reply("^7Your query yielded no results.")
+            return
+        self.show_db_rows(key, query, columns, rows, offset, row_cap, paged, channel)
+
+    def show_db_rows(self, key, query, columns, rows, offset, row_cap, paged, channel):
+        """Show a page of rows. Paged rows already start at offset. The rows of a query
+        that isn't paged are all there, and are kept for !db more.
+
+        """
+        all_rows = rows
+        if not paged:
+            rows = rows[offset:]
+        more = len(rows) > row_cap
+        rows = rows[:row_cap]
+        limit = DB_REPLY_LENGTH.get(getattr(channel, "name", None), DB_REPLY_LENGTH[None])
+        lines = []
+        line = "^7{}".format(tuple(columns))
+        for row in rows:
+            entry = "{}".format(tuple(row))
+            if len(line) + len(entry) + 3 > limit:
+                lines.append(line)
+                line = "^7" + entry
+            else:
+                line += " | " + entry
+        lines.append(line)
+        for line in lines:
+            channel.reply(line)
+
+        if more:
+            if paged:
+                self.db_cursors[key] = (query, offset + row_cap, None, None)
+            else:
+                self.db_cursors[key] = (query, offset + row_cap, columns, all_rows)
+            channel.reply("^7Showing rows ^6{}^7-^6{}^7. Use ^6!db more^7 for the next ones."
+                .format(offset + 1, offset + row_cap))
 
     def cmd_seen(self, player, msg, channel):
         if len(msg) < 2:
@@ -301,15 +505,21 @@ class essentials(minqlbot.Plugin):
         name = self.clean_text(msg[1]).lower()
         if name == minqlbot.NAME.lower():
             channel.reply("^7Does taking a selfie count?")
-        elif name == player.clean_name.lower():
+        elif name == playerkeys.key(player):
             channel.reply("^7Depends. Are you ^6hot^7?")
         elif self.player(name):
             channel.reply("^7But that player's already here, you ^6dummy^7!")
         else:
-            c = self.db_query("SELECT last_seen FROM Players WHERE name=?", name)
-            row = c.fetchone()
-            if row and row["last_seen"]:
-                then = datetime.datetime.strptime(row["last_seen"], DATETIME_FORMAT)
+            last_seen = self.last_seen(name)
+            if not last_seen:
+                # Maybe we've seen them on their main account.
+                main = aliasindex.get_index().resolve(name)
+                if main != name:
+                    last_seen = self.last_seen(main)
+                    if last_seen:
+                        name = "{} (as {})".format(name, main)
+            if last_seen:
+                then = datetime.datetime.strptime(last_seen, DATETIME_FORMAT)
                 td = datetime.datetime.now() - then
                 r = re.match(r'((?P<d>.*) days*, )?(?P<h>..?):(?P<m>..?):.+', str(td))
                 if r.group("d"):
@@ -362,24 +572,79 @@ class essentials(minqlbot.Plugin):
     # ====================================================================
 
     def update_player(self, player):
-        """Updates the 'last_seen' entry in the database or add to database if it's a new player.
+        """Updates the 'last_seen' entry of a player. The write is held back and coalesced
+        with others until the next flush_seen().
 
         """
-        name = player.clean_name.lower()
-        c = self.db_query("SELECT * FROM Players WHERE name=?", name)
-        row = c.fetchone()
+        name = playerkeys.key(player)
         now = datetime.datetime.now().strftime(DATETIME_FORMAT)
-        if not row:
-            self.db_query("INSERT INTO Players VALUES(?, 0, ?, 0, 0)", name, now)
-            self.db_commit()
+        with self.seen_lock:
+            self.seen[name] = now
+
+    def last_seen(self, name):
+        # Read through the pending writes first.
+        with self.seen_lock:
+            last_seen = self.seen.get(name) or self.flushing.get(name)
+        if not last_seen:
+            c = self.db_query(database.queries.LAST_SEEN, name)
+            row = c.fetchone()
+            if row:
+                last_seen = row["last_seen"]
+        return last_seen
+
+    def flush_seen(self):
+        """Write pending 'last_seen' entries to the database in a single transaction,
+        adding players we haven't seen before.
+
+        """
+        with self.seen_lock:
+            if not self.seen:
+                return
+            pending = self.seen
+            self.seen = {}
+            self.flushing.update(pending)
+
+        future = database.get_executor().call(write_seen, list(pending.items()))
+        future.add_done_callback(lambda f: self.flushed(f, pending))
+        return future
+
+    def flushed(self, future, pending):
+        e = future.exception()
+        if e:
+            self.debug("Failed to save last seen: {}: {}. Retrying with the next flush.".format(e.__class__.__name__, e))
+        with self.seen_lock:
+            for name, last_seen in pending.items():
+                if self.flushing.get(name) == last_seen:
+                    del self.flushing[name]
+                # Put them back for the next flush, unless they've been seen again since.
+                if e:
+                    self.seen.setdefault(name, last_seen)
+
+    def schedule_flush(self):
+        interval = self.settings.seen_flush_interval
+        # Zero would have the scheduler flushing nonstop. Without a timer, we still flush
+        # at the end of every game and on unload.
+        if interval > 0:
+            self.flush_timer = scheduler.schedule(interval, self.flush_seen_timer)
+
+    def flush_seen_timer(self):
+        if self.unloaded:
             return
-        else:
-            self.db_query("UPDATE Players SET last_seen=? WHERE name=?", now, name)
-            self.db_commit()
+        try:
+            self.flush_seen()
+        finally:
+            self.schedule_flush()
 
     def resolve_vote(self):
-        self.debug("RESOLVE")
+        with self.vote_lock:
+            if self.vote_resolved:
+                return
+            self.vote_resolved = True
+            tally = tuple(self.vote_tally) if self.vote_tally else None
         votes = self.current_vote_count()
+        if not votes:
+            # The tally is still good if asking the server failed.
+            votes = tally
         if not votes:
             self.debug("resolve_votes: Where'd the votes go?")
         elif votes[0] > votes[1]:
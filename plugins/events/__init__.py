@@ -0,0 +1 @@
+from plugins.events.events import subscribe, unsubscribe, publish, RATING_CHANGED, ALIAS_CHANGED, BAN_CHANGED, PERMISSION_CHANGED, DATA_EVENTS
\ No newline at end of file
@@ -0,0 +1,75 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""A small publish/subscribe bus so plugins can tell each other that data changed
+without reaching into each other's internals.
+
+Every event carries the lowercase clean names it's about, or None if it could be about
+anyone, like after a raw query through !db. Subscribers invalidate whatever they have
+cached on those names. Callbacks run synchronously on the publisher's thread, so they
+should be quick and take their own locks.
+
+    events.subscribe(self, events.RATING_CHANGED, self.drop_ratings)
+    events.publish(events.RATING_CHANGED, ("minomino",))
+"""
+
+import threading
+import traceback
+
+RATING_CHANGED = "rating_changed"
+ALIAS_CHANGED = "alias_changed"
+BAN_CHANGED = "ban_changed"
+PERMISSION_CHANGED = "permission_changed"
+# Everything a raw write to the database can change behind our backs.
+DATA_EVENTS = (RATING_CHANGED, ALIAS_CHANGED, BAN_CHANGED, PERMISSION_CHANGED)
+
+_subscribers = {}
+_lock = threading.RLock()
+
+def subscribe(plugin, event, callback):
+    """Call callback(names) whenever event is published. Subscriptions are kept per plugin
+    class, so a reloaded plugin replaces the subscriptions of its old instance.
+
+    """
+    with _lock:
+        owners = _subscribers.setdefault(event, {})
+        owners[plugin.__class__.__name__] = (plugin, callback)
+
+def unsubscribe(plugin):
+    with _lock:
+        for owners in _subscribers.values():
+            name = plugin.__class__.__name__
+            if name in owners and owners[name][0] is plugin:
+                del owners[name]
+
+def publish(event, names=None):
+    if names is not None:
+        names = frozenset(names)
+    with _lock:
+        subscribers = list(_subscribers.get(event, {}).values())
+
+    for plugin, callback in subscribers:
+        try:
+            callback(names)
+        except:
+            # One broken subscriber shouldn't keep the others from invalidating.
+            import minqlbot
+            e = traceback.format_exc().rstrip("\n")
+            minqlbot.debug("========== ERROR: {}@{} ==========".format(plugin.__class__.__name__, event))
+            for line in e.split("\n"):
+                minqlbot.debug(line)
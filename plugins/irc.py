@@ -23,6 +23,9 @@ import re
 import minqlbot
 import traceback
 
+import plugins.playerkeys as playerkeys
+import plugins.roster as roster
+
 from threading import Thread
 
 class IrcAdminChannel(minqlbot.AbstractChannel):
@@ -79,7 +82,7 @@ class irc(minqlbot.Plugin):
         self.privmsg(self.admin_channel, "{}\r\n".format(msg))
     
     def handle_game_chat(self, player, msg, channel):
-        if (player.clean_name.lower() == minqlbot.NAME.lower() and msg.startswith("^6<^7")) or msg == "(muted)":
+        if (playerkeys.key(player) == minqlbot.NAME.lower() and msg.startswith("^6<^7")) or msg == "(muted)":
             # TODO: More elegant solution to msg.startswith("^6<^7")
             return
         elif channel == "chat":
@@ -107,7 +110,7 @@ class irc(minqlbot.Plugin):
             self.msg("^6<^7{}^6> ^5{}".format(user, " ".join(split_msg[1:])), "team_chat")
         # .players - List players currently on the server.
         elif split_msg[0] == ".players":
-                teams = self.teams()
+                teams = roster.get_roster().snapshot()
                 game = self.game()
                 # Make a list of players.
                 plist = ""
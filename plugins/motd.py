@@ -17,56 +17,88 @@
 # along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
 
 import minqlbot
+import threading
 import time
 
+import plugins.database as database
+import plugins.settings as settings
+import plugins.playerkeys as playerkeys
+import plugins.scheduler as scheduler
+from plugins.settings import Setting
+
+# Seconds before a reconnecting player is sent the MOTD again.
+REPEAT_WINDOW = 3600
+# How many past MOTDs are kept in the database.
+KEEP_HISTORY = 10
+# Players we sent the MOTD to outside the repeat window are forgotten once there are this many.
+SENT_PRUNE_SIZE = 512
+
+SETTINGS = (
+    Setting("repeat_window", "RepeatWindow", int, REPEAT_WINDOW),
+    Setting("keep_history", "KeepHistory", int, KEEP_HISTORY),
+    )
+
 class motd(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        settings.register(self, "Motd", SETTINGS)
+        self.add_hook("unload", self.handle_unload)
         self.add_hook("player_connect", self.handle_player_connect, minqlbot.PRI_LOWEST)
         self.add_command("motd", self.cmd_motd, 4, usage="(set <motd> | add <motd> | clear | get)")
 
+        c = self.db_query(database.queries.CURRENT_MOTD)
+        row = c.fetchone()
+        self.current = row["message"] if row and row["message"] else ""
+        # Keys: lowercase clean name - Items: when we last sent them the MOTD.
+        self.sent = {}
+        # Saving a new MOTD clears it from the database thread.
+        self.sent_lock = threading.Lock()
+        self.trim_history()
+
+    def handle_unload(self):
+        settings.unregister(self)
+        scheduler.cancel("motd")
+
     def handle_player_connect(self, player):
         """Send the message of the day to the player in a tell.
 
         This should be set to lowest priority so that we don't execute anything if "ban" or
         a similar plugin determines the player should be kicked.
         """
-        c = self.db_query("SELECT message FROM Motd ORDER BY time DESC LIMIT 1")
-        row = c.fetchone()
-        if row and row["message"]:
-            self.delay(15, self.tell_motd, args=(player, row["message"]))
+        if not self.current:
+            return
+
+        window = self.settings.repeat_window
+        now = time.time()
+        name = playerkeys.key(player)
+        with self.sent_lock:
+            if name in self.sent and now - self.sent[name] < window:
+                return
+            self.sent[name] = now
+            if len(self.sent) > SENT_PRUNE_SIZE:
+                self.sent = {n: t for n, t in self.sent.items() if now - t < window}
+        scheduler.schedule(15, self.tell_motd, args=(player, self.current), key=("motd", name))
 
     def cmd_motd(self, player, msg, channel):
         if len(msg) < 2:
             return minqlbot.RET_USAGE
         # NEW
         elif msg[1].lower() == "set" or msg[1].lower() == "new":
-            new_motd = " ".join(msg[2:])
-            self.db_query("INSERT INTO Motd VALUES(?, ?, ?)", int(time.time()), player.clean_name.lower(), new_motd)
-            self.db_commit()
-            channel.reply("^7You have successfully set a new MOTD.")
+            self.set_motd(player, " ".join(msg[2:]), channel, "^7You have successfully set a new MOTD.")
         # ADD
         elif msg[1].lower() == "add":
-            c = self.db_query("SELECT message FROM Motd ORDER BY time DESC LIMIT 1")
-            row = c.fetchone()
-            if row and row["message"]:
-                add_motd = "{} {}".format(row["message"], " ".join(msg[2:]))
-                self.db_query("INSERT INTO Motd VALUES(?, ?, ?)", int(time.time()), player.clean_name.lower(), add_motd)
-                self.db_commit()
-                channel.reply("^7The current MOTD has been successfully updated.")
+            if self.current:
+                self.set_motd(player, "{} {}".format(self.current, " ".join(msg[2:])),
+                    channel, "^7The current MOTD has been successfully updated.")
             else:
                 channel.reply("^7There is no active MOTD.")
         # CLEAR
         elif msg[1].lower() == "clear":
-            self.db_query("INSERT INTO Motd VALUES(?, ?, ?)", int(time.time()), player.clean_name.lower(), "")
-            self.db_commit()
-            channel.reply("^7You have successfully cleared the MOTD.")
+            self.set_motd(player, "", channel, "^7You have successfully cleared the MOTD.")
         # GET
         elif msg[1].lower() == "get":
-            c = self.db_query("SELECT message FROM Motd ORDER BY time DESC LIMIT 1")
-            row = c.fetchone()
-            if row and row["message"]:
-                channel.reply("^7The current MOTD: ^2{}".format(row["message"]))
+            if self.current:
+                channel.reply("^7The current MOTD: ^2{}".format(self.current))
             else:
                 channel.reply("^7There is no active MOTD.")
     
@@ -74,3 +106,30 @@ class motd(minqlbot.Plugin):
         self.tell("^6*** ^7Message of the Day ^6***", player)
         self.tell(msg, player)
 
+    def set_motd(self, player, message, channel, reply):
+        """Save a new MOTD and start using it once it's been written, then reply to the
+        channel. Two set in the same second share a time, so the later one replaces the first.
+
+        """
+        future = database.get_executor().execute("INSERT OR REPLACE INTO Motd VALUES(?, ?, ?)",
+            int(time.time()), playerkeys.key(player), message)
+        future.add_done_callback(lambda f: self.motd_saved(f, message, channel, reply))
+
+    def motd_saved(self, future, message, channel, reply):
+        e = future.exception()
+        if e:
+            self.debug("Failed to save the MOTD: {}: {}".format(e.__class__.__name__, e))
+            channel.reply("^1{}^7: {}".format(e.__class__.__name__, e))
+            return
+        self.current = message
+        # Everyone should get to see the new one.
+        with self.sent_lock:
+            self.sent = {}
+        self.trim_history()
+        channel.reply(reply)
+
+    def trim_history(self):
+        """Delete all but the most recent MOTDs."""
+        keep = self.settings.keep_history
+        database.get_executor().execute("DELETE FROM Motd WHERE time NOT IN "
+            "(SELECT time FROM Motd ORDER BY time DESC LIMIT ?)", max(keep, 1))
@@ -17,13 +17,95 @@
 # along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
 
 import minqlbot
+import threading
+
+import plugins.database as database
+import plugins.events as events
+import plugins.playerkeys as playerkeys
 
 class permission(minqlbot.Plugin):
     def __init__(self):
+        self.add_hook("unload", self.handle_unload)
+        events.subscribe(self, events.PERMISSION_CHANGED, self.handle_permission_changed)
         self.add_command("setperm", self.cmd_setperm, 5, usage="<name> <level>")
         self.add_command("getperm", self.cmd_getperm, 5, usage="<name>")
         self.add_command("myperm", self.cmd_myperm, 0, channels=("chat", "team_chat", "tell"))
 
+        # Keys: lowercase clean name - Items: permission level. Players we've never seen
+        # aren't cached, so they keep hitting the database until they are.
+        self.cache = {}
+        self.cache_lock = threading.RLock()
+        self.reload_permissions()
+        self.install_cache()
+
+    def handle_unload(self):
+        events.unsubscribe(self)
+        self.uninstall_cache()
+
+    def handle_permission_changed(self, names):
+        if names is None:
+            self.reload_permissions()
+        else:
+            with self.cache_lock:
+                for name in names:
+                    self.cache.pop(name, None)
+
+    def install_cache(self):
+        """Route every plugin's permission lookups, and therefore command authorization,
+        through our cache instead of the database.
+
+        """
+        original = minqlbot.Plugin.get_permission
+        if getattr(original, "cached", False):
+            original = original.original
+        plugin = self
+
+        def get_permission(self, name):
+            key = plugin.cache_key(name)
+            with plugin.cache_lock:
+                if key in plugin.cache:
+                    return plugin.cache[key]
+            perm = original(self, name)
+            if perm is not None:
+                with plugin.cache_lock:
+                    plugin.cache[key] = perm
+            return perm
+        get_permission.cached = True
+        get_permission.original = original
+        get_permission.__doc__ = original.__doc__
+        minqlbot.Plugin.get_permission = get_permission
+
+    def uninstall_cache(self):
+        if getattr(minqlbot.Plugin.get_permission, "cached", False):
+            minqlbot.Plugin.get_permission = minqlbot.Plugin.get_permission.original
+
+    def cache_key(self, name):
+        if not hasattr(name, "clean_name"):
+            name = str(name)
+        return playerkeys.key(name)
+
+    def reload_permissions(self):
+        """Load everyone with a permission level into the cache, dropping everything else.
+        Publish PERMISSION_CHANGED after writing to Players behind our back.
+
+        This is often called from the done callback of a database future, so it goes
+        through the executor rather than our own connection, and the cache is swapped
+        once the query is done.
+
+        """
+        future = database.get_executor().query("SELECT name, permission FROM Players WHERE permission!=0")
+        future.add_done_callback(self.permissions_loaded)
+        return future
+
+    def permissions_loaded(self, future):
+        e = future.exception()
+        if e:
+            self.debug("Failed to reload permissions: {}: {}".format(e.__class__.__name__, e))
+            return
+        cache = {row["name"]: row["permission"] for row in future.result()}
+        with self.cache_lock:
+            self.cache = cache
+
     def cmd_setperm(self, player, msg, channel):
         if len(msg) < 3:
             return minqlbot.RET_USAGE
@@ -41,7 +123,7 @@ class permission(minqlbot.Plugin):
             channel.reply("^6{}^7 has permission level ^6{}^7.".format(msg[1], perm))
 
     def cmd_myperm(self, player, msg, channel):
-        name = player.clean_name.lower()
+        name = playerkeys.key(player)
         perm = self.get_permission(name)
         if perm == None:
             channel.reply("^7I do not know you.")
@@ -56,15 +138,19 @@ class permission(minqlbot.Plugin):
             channel.reply("^7Unintelligible permission level.")
             return
         
-        c = self.db_query("SELECT * FROM Players WHERE name=?", name)
+        c = self.db_query(database.queries.PLAYER, name)
         if not c.fetchone():
-            self.db_query("INSERT INTO Players VALUES(?, ?, '', 0, 0)", name, lvl)
+            self.db_query("INSERT INTO Players(name, permission, last_seen, games_completed, games_left) VALUES(?, ?, '', 0, 0)", name, lvl)
             self.db_commit()
+            with self.cache_lock:
+                self.cache[name] = lvl
             channel.reply("^6{}^7 has been added as a player with permission level ^6{}^7."
                 .format(name, lvl))
         else:
             self.db_query("UPDATE Players SET permission=? WHERE name=?", lvl, name)
             self.db_commit()
+            with self.cache_lock:
+                self.cache[name] = lvl
             channel.reply("^6{}^7's permission level has been set to ^6{}^7."
                 .format(name, lvl))
 
@@ -0,0 +1 @@
+from plugins.playerkeys.playerkeys import key, keys
\ No newline at end of file
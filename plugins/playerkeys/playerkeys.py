@@ -0,0 +1,99 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Canonical player keys.
+
+Everything we cache or store about a player is keyed by their lowercase name without
+color tags. Working that out means a regex substitution and a lowercase copy, and the
+hot paths used to do it over and over for the same handful of players, like once per
+player per candidate swap in !balance. key() does it once per distinct raw name and
+hands back the same interned string from then on, so the rest is a dict lookup and the
+keys compare by identity.
+
+Run this file directly to benchmark the work it saves in a !balance run:
+
+    python -m plugins.playerkeys.playerkeys [players_per_team] [runs]
+"""
+
+import re
+import sys
+
+# The same tags minqlbot.Plugin.clean_text strips.
+COLOR_TAG = re.compile(r"\^[^\^]")
+# Names are only ever added, so keep it from growing forever on a long running bot.
+MAX_KEYS = 4096
+
+_keys = {}
+
+def key(player):
+    """The canonical key of a Player or a name, with or without color tags."""
+    name = getattr(player, "name", player)
+    try:
+        return _keys[name]
+    except KeyError:
+        pass
+
+    if name is not player:
+        k = player.clean_name.lower()
+    else:
+        k = COLOR_TAG.sub("", name).lower()
+    k = sys.intern(k)
+    if len(_keys) >= MAX_KEYS:
+        _keys.clear()
+    _keys[name] = k
+    return k
+
+def keys(players):
+    return [key(p) for p in players]
+
+def benchmark(per_team=8, runs=1000):
+    """Time the key computations of suggest_switch, the bulk of a !balance run, which
+    averages both teams once for every possible red/blue swap.
+
+    """
+    import timeit
+
+    class Player:
+        def __init__(self, name):
+            self.name = name
+        @property
+        def clean_name(self):
+            return COLOR_TAG.sub("", self.name)
+
+    red = [Player("^1Red^7Player{}".format(i)) for i in range(per_team)]
+    blue = [Player("^4Blue^7Player{}".format(i)) for i in range(per_team)]
+    # Every swap averages both teams, and each average goes over every player.
+    lookups = (per_team ** 2 + 1) * per_team * 2
+    players = (red + blue) * (lookups // (per_team * 2))
+
+    def recompute():
+        for p in players:
+            p.clean_name.lower()
+
+    def cached():
+        for p in players:
+            key(p)
+
+    print("{} players per team, {} key lookups per !balance, {} runs:".format(per_team, lookups, runs))
+    for label, func in (("clean_name.lower()", recompute), ("playerkeys.key()", cached)):
+        t = timeit.timeit(func, number=runs)
+        print("  {:<20} {:8.3f} ms per !balance".format(label, t / runs * 1000))
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    benchmark(*args)
@@ -17,14 +17,42 @@
 # along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
 
 import minqlbot
+import plugins.database as database
+import plugins.settings as settings
+import plugins.roster as roster
+import plugins.ratelimit as ratelimit
+import plugins.scheduler as scheduler
 
 class plugin_manager(minqlbot.Plugin):
     def __init__(self):
+        # We're loaded first, so set up the database and bring the schema up to date before anyone uses it.
+        database.configure(self)
+        applied = database.migrate(self)
+        if applied:
+            self.debug("Applied {} database migration(s).".format(applied))
+        # Start the thread that owns the shared connection plugins queue writes on.
+        database.get_executor()
+        # Follow who's on which team for everyone.
+        roster.get_roster().install(self)
+        # Every command registered from here on goes through the rate limiter.
+        settings.register(self, "RateLimit", ratelimit.SETTINGS, attribute="rate_limits")
+        ratelimit.install(minqlbot.Plugin, self)
+
+        self.add_hook("unload", self.handle_unload)
         self.add_command("load", self.cmd_load, 5, usage="<plugin>")
         self.add_command("unload", self.cmd_unload, 5, usage="<plugin>")
         self.add_command("reload", self.cmd_reload, 5, usage="<plugin>")
         self.add_command(("reload_config", "reloadconfig"), self.cmd_reload_config, 5)
+        self.add_command("timers", self.cmd_timers, 5)
     
+    def handle_unload(self):
+        roster.get_roster().uninstall()
+        ratelimit.uninstall()
+        settings.unregister(self)
+        scheduler.stop_scheduler()
+        # Commits anything still queued.
+        database.stop_executor()
+
     def cmd_load(self, player, msg, channel):
         if len(msg) < 2:
             channel.reply("^7Usage: ^6!load <plugin>")
@@ -64,10 +92,22 @@ class plugin_manager(minqlbot.Plugin):
                     .format(msg[1]))
                 raise
     
+    def cmd_timers(self, player, msg, channel):
+        s = scheduler.get_scheduler()
+        next_due = s.next_due()
+        channel.reply("^6{}^7 timer(s) queued{}. ^6{}^7 fired and ^6{}^7 coalesced so far."
+            .format(s.pending(), "" if next_due is None else ", next in ^6{}^7 seconds".format(round(next_due, 1)),
+                s.fired, s.coalesced))
+
     def cmd_reload_config(self, player, msg, channel):
         try:
             minqlbot.reload_config()
-            channel.reply("^7The config file was reloaded successfully.")
+            errors = settings.reload(minqlbot.get_config())
+            if errors:
+                for error in errors:
+                    channel.reply("^7Invalid value, using default: ^6{}".format(error))
+            else:
+                channel.reply("^7The config file was reloaded successfully.")
         except:
             channel.reply("^7The config file has failed to reload.")
             raise
@@ -1 +1 @@
-from plugins.qlprofile.qlprofile import get_profile
+from plugins.qlprofile.qlprofile import get_profile, QL_URL
\ No newline at end of file
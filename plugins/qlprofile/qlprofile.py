@@ -4,30 +4,81 @@ import urllib.error
 import html.parser
 import http.cookiejar
 import datetime
+import codecs
+import time
 import sys
 
 from html.parser import HTMLParser
 
 QL_URL = "http://quakelive.com/"
+CHUNK_SIZE = 4096
+
+MONTHS = {"Jan.": 1, "Feb.": 2, "Mar.": 3, "Apr.": 4, "May.": 5, "Jun.": 6,
+          "Jul.": 7, "Aug.": 8, "Sep.": 9, "Oct.": 10, "Nov.": 11, "Dec.": 12}
+
+def parse_created(created):
+    """Turn a "Member Since" string like "Jan. 5, 2010" into a datetime.date.
+
+    """
+    split = created.split()
+    return datetime.date(int(split[2]), MONTHS[split[0]], int(split[1].rstrip(",")))
 
 class QlProfileParser(HTMLParser):
-    def __init__(self, strict=False):
-        HTMLParser.__init__(self, strict=strict)
+    """Parses a profile page. If given a collection of field names, the parser
+    will consider itself done as soon as those have been captured, letting
+    the caller stop feeding it the rest of the page.
+
+    Text is collected until the next tag and handled as a whole, since HTMLParser
+    hands over whatever partial text it has at the end of every feed(), which would
+    otherwise make labels split across chunks go unnoticed.
+
+    """
+    def __init__(self, fields=None, strict=False):
+        # Only Python 3.4 and older take strict. Later ones are always lenient.
+        try:
+            HTMLParser.__init__(self, strict=strict)
+        except TypeError:
+            HTMLParser.__init__(self)
         self.profile = QlProfile()
         self.capture = ""
+        self.text = []
+        self.fields = set(fields) if fields else None
+        self.captured = set()
+
+    @property
+    def done(self):
+        return self.fields is not None and self.fields <= self.captured
+
+    def set_captured(self, field):
+        self.captured.add(field)
+        self.capture = ""
     
+    def close(self):
+        HTMLParser.close(self)
+        self.handle_text()
+
     def handle_starttag(self, tag, attrs):
+        self.handle_text()
         if tag == "div" and ("id", "prf_player_name") in attrs:
             self.capture = "name"
         elif tag == "img" and ("class", "playerflag") in attrs:
             for attr in attrs:
                 if attr[0] == "title":
                     self.profile.country = attr[1]
+                    self.captured.add("country")
         #print("Encountered a start tag:", tag, "   ", attrs)
     def handle_endtag(self, tag):
-        pass
+        self.handle_text()
         #print("Encountered an end tag :", tag)
     def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_text(self):
+        """Handle all the text since the last tag in one go."""
+        if not self.text:
+            return
+        data = "".join(self.text)
+        self.text = []
         # Set up to grab the data the next time this is called.
         if data == "Member Since:":
             self.capture = "created"
@@ -49,37 +100,30 @@ class QlProfileParser(HTMLParser):
         elif self.capture and data.strip():
             if self.capture == "name":
                 self.profile.name = data.strip()
-                self.capture = ""
             elif self.capture == "created":
                 self.profile.created = data.strip()
-                self.capture = ""
+                self.profile.created_date = parse_created(self.profile.created)
             elif self.capture == "played":
                 self.profile.played = data.strip()
-                self.capture = ""
             elif self.capture == "last_game":
                 self.profile.last_game = data.strip()
-                self.capture = ""
             elif self.capture == "wins":
                 self.profile.wins = data.strip()
-                self.capture = ""
             elif self.capture == "losses_quits":
                 split = data.split("/")
                 self.profile.losses = split[0].strip()
                 self.profile.quits = split[1].strip()
-                self.capture = ""
             elif self.capture == "frags_deaths":
                 split = data.split("/")
                 self.profile.frags = split[0].strip()
                 self.profile.deaths = split[1].strip()
-                self.capture = ""
             elif self.capture == "hits_shots":
                 split = data.split("/")
                 self.profile.hits = split[0].strip()
                 self.profile.shots = split[1].strip()
-                self.capture = ""
             elif self.capture == "accuracy":
                 self.profile.accuracy = data.strip()
-                self.capture = ""
+            self.set_captured(self.capture)
             
 
 class QlProfile():
@@ -98,50 +142,122 @@ class QlProfile():
         self.hits = hits
         self.shots = shots
         self.accuracy = accuracy
+        # Set by the parser, so is_eligible() doesn't have to parse the string every time.
+        self.created_date = None
     
     def get_day(self):
-        return int(self.created.split()[1].rstrip(","))
+        return self.get_date().day
     
     def get_month(self):
-        month = self.created.split()[0]
-        if month == "Jan.": return 1
-        elif month == "Feb.": return 2
-        elif month == "Mar.": return 3
-        elif month == "Apr.": return 4
-        elif month == "May.": return 5
-        elif month == "Jun.": return 6
-        elif month == "Jul.": return 7
-        elif month == "Aug.": return 8
-        elif month == "Sep.": return 9
-        elif month == "Oct.": return 10
-        elif month == "Nov.": return 11
-        elif month == "Dec.": return 12
+        return self.get_date().month
     
     def get_year(self):
-        return int(self.created.split()[2])
+        return self.get_date().year
     
     def get_date(self):
-        return datetime.date(self.get_year(), self.get_month(), self.get_day())
+        if self.created_date is None:
+            self.created_date = parse_created(self.created)
+        return self.created_date
     
     def is_eligible(self, days):
         td = datetime.timedelta(days=days)
         min = datetime.date.today() - td
         return (self.get_date() < min)
 
-def get_profile(name):
+def get_profile(name, fields=None, chunk_size=CHUNK_SIZE, base_url=QL_URL):
+    """Fetch and parse a profile. The page is fed to the parser in chunks as it comes in,
+    and if a collection of fields is given (e.g. ("created",)), we stop reading as soon
+    as those have been captured.
+
+    """
     cookies = http.cookiejar.CookieJar(http.cookiejar.DefaultCookiePolicy())
     opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
-    url = QL_URL + "profile/summary/" + name.lower()
+    if not base_url.endswith("/"):
+        base_url += "/"
+    url = base_url + "profile/summary/" + name.lower()
     request = urllib.request.Request(url, 
         headers={"User-Agent": "Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; Trident/5.0)"})
     res = opener.open(request)
-    data = res.read()
-    parser = QlProfileParser()
-    parser.feed(data.decode())
+    try:
+        return parse_stream(res, fields, chunk_size)
+    finally:
+        res.close()
+
+def parse_stream(stream, fields=None, chunk_size=CHUNK_SIZE):
+    """Feed a file-like object to a QlProfileParser and return the profile.
+
+    """
+    parser = QlProfileParser(fields)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while not parser.done:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            break
+        parser.feed(decoder.decode(chunk))
     return parser.profile
 
+def check_chunking(path):
+    """Split a saved page in two at every offset and check that it always parses the
+    same as when it's fed all at once. Returns the offsets where it doesn't.
+
+    """
+    import io
+    with open(path, "rb") as f:
+        data = f.read()
+    expected = vars(parse_stream(io.BytesIO(data), chunk_size=len(data) + 1))
+
+    class Split(io.BytesIO):
+        def __init__(self, data, offset):
+            super().__init__(data)
+            self.offset = offset
+        def read(self, size=-1):
+            # The first read stops at the offset, the rest come as asked.
+            if self.tell() < self.offset:
+                size = self.offset - self.tell()
+            return super().read(size)
+
+    return [offset for offset in range(1, len(data))
+            if vars(parse_stream(Split(data, offset), chunk_size=len(data))) != expected]
+
+def benchmark(paths, iterations=100):
+    """Compare full and early-terminating parsing of saved profile pages.
+
+    """
+    import io
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        for label, fields in (("full", None), ("created", ("created",))):
+            start = time.perf_counter()
+            for i in range(iterations):
+                profile = parse_stream(io.BytesIO(data), fields)
+            elapsed = (time.perf_counter() - start) / iterations
+            print("{} [{}]: {:.3f} ms/page (created: {})"
+                .format(path, label, elapsed * 1000, profile.created_date))
+
 if __name__ == "__main__":
-    profile = get_profile("vodkaman")
+    # Usage: qlprofile.py [--url base_url] [saved_page ...]
+    # Pass saved profile pages as arguments to benchmark the parser instead.
+    #        qlprofile.py --check saved_page -- fails if splitting the page anywhere changes the result.
+    args = sys.argv[1:]
+    if len(args) > 1 and args[0] == "--check":
+        bad = check_chunking(args[1])
+        if bad:
+            print("Parsed differently when split at offset(s): {}".format(", ".join(str(o) for o in bad[:20])))
+            sys.exit(1)
+        print("Parsed the same wherever the page was split.")
+        sys.exit()
+    base_url = QL_URL
+    if len(args) > 1 and args[0] == "--url":
+        base_url = args[1]
+        args = args[2:]
+    if args:
+        benchmark(args)
+        sys.exit()
+
+    profile = get_profile("vodkaman", base_url=base_url)
     
     print("Name: {}".format(profile.name))
     print("Country: {}".format(profile.country))
@@ -1 +1 @@
-from plugins.qlranks.qlranks import QlRanks
+from plugins.qlranks.qlranks import QlRanks, QLRANKS_URL
\ No newline at end of file
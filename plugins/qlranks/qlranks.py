@@ -23,15 +23,20 @@ Created on 19 Oct 2013
 # along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
 
 import http.client
+import urllib.parse
 import json
 import threading
-import minqlbot
 import traceback
+import sys
+
+import plugins.aliasindex as aliasindex
+
+QLRANKS_URL = "http://www.qlranks.com/"
 
 class QlRanks(threading.Thread):
     instances = 0
 
-    def __init__(self, plugin, players, check_alias=True):
+    def __init__(self, plugin, players, check_alias=True, base_url=QLRANKS_URL):
         threading.Thread.__init__(self)
         self.uid = self.instances
         self.plugin = plugin
@@ -39,23 +44,25 @@ class QlRanks(threading.Thread):
         self.status = 0
         self.check_alias = check_alias
         self.aliases = {}
+        self.base_url = base_url
         QlRanks.instances += 1
     
     def run(self):
         try:
             self.plugin.debug("QLRanks thread #{} started!".format(self.uid))
-            if self.check_alias:
+            if self.check_alias and self.players:
+                # Follows chains of aliases all the way to the main account.
+                index = aliasindex.get_index()
                 for i in range(len(self.players)):
-                    c = self.plugin.db_query("SELECT name FROM Aliases WHERE other_name=?", self.players[i])
-                    res = c.fetchone()
-                    if res:
-                        self.aliases[res["name"]] = self.players[i]
-                        self.players[i] = res["name"]
-                self.plugin.db_close()
+                    main = index.resolve(self.players[i])
+                    if main != self.players[i]:
+                        self.aliases[main] = self.players[i]
+                        self.players[i] = main
             
             try:
+                host, path = split_url(self.base_url)
                 player_list = "+".join(self.players)
-                data = self.get_data("www.qlranks.com", "/api.aspx?nick={}".format(player_list))
+                data = self.get_data(host, "{}api.aspx?nick={}".format(path, player_list))
             except:
                 self.status = -2
                 self.plugin.cache_players(None, self)
@@ -81,9 +88,9 @@ class QlRanks(threading.Thread):
         except:
             self.status = -3
             e = traceback.format_exc().rstrip("\n")
-            minqlbot.debug("========== ERROR: QLRanks Fetcher #{} ==========".format(self.uid))
+            self.plugin.debug("========== ERROR: QLRanks Fetcher #{} ==========".format(self.uid))
             for line in e.split("\n"):
-                minqlbot.debug(line)
+                self.plugin.debug(line)
             self.plugin.cache_players(None, self)
             self.plugin.execute_pending()
     
@@ -106,6 +113,18 @@ class QlRanks(threading.Thread):
         else:
             return None
 
+def split_url(base_url):
+    """Split a base URL like "http://localhost:8080/qlranks/" into the host
+    http.client wants and a path prefix ending with a slash.
+
+    """
+    split = urllib.parse.urlsplit(base_url)
+    path = split.path if split.path.endswith("/") else split.path + "/"
+    return split.netloc, path
+
 if __name__ == "__main__":
-    qlr = QlRanks(["minomino", "minobot", "mino"], lambda x: print(x))
-    qlr.run()
\ No newline at end of file
+    # Usage: qlranks.py [base_url] -- point it at the local stand-in to stay offline.
+    qlr = QlRanks(None, ["minomino", "minobot", "mino"], check_alias=False,
+                  base_url=sys.argv[1] if len(sys.argv) > 1 else QLRANKS_URL)
+    host, path = split_url(qlr.base_url)
+    print(qlr.get_data(host, "{}api.aspx?nick={}".format(path, "+".join(qlr.players))))
\ No newline at end of file
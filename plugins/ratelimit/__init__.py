@@ -0,0 +1 @@
+from plugins.ratelimit.ratelimit import RateLimiter, TokenBucket, get_limiter, install, uninstall, SETTINGS
\ No newline at end of file
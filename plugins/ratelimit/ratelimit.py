@@ -0,0 +1,242 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Token bucket rate limiting in front of every command handler.
+
+Every player gets a bucket for commands in general and one per limited command, and
+commands that hit the network, like anything that might go to QLRanks, also share a
+global bucket so a few players together can't flood it either. Commands that only look
+things up can be listed in MergeCommands, and one of them repeated with the same
+arguments while the first is still fresh is merged into it, which just means the player
+is told it's already been answered instead of it running again.
+
+Limits are written as count/seconds, so 3/30 is a burst of 3 refilling at one every 10
+seconds, and 0 means no limit. They're read from the [RateLimit] section:
+
+    PlayerLimit: 6/30
+    CommandLimits: teams=2/30, getrating=3/30
+    LevelLimits: 1=12/30, 3=0
+    NetworkLimit: 10/60
+    NetworkCommands: teams, balance, getrating, ratings
+    MergeCommands: teams, getrating, ratings
+
+The wrapping happens in add_command, so it's installed by plugin_manager before any
+other plugin registers commands.
+"""
+
+import threading
+import time
+
+import minqlbot
+import plugins.playerkeys as playerkeys
+from plugins.settings import Setting
+
+# Buckets that have refilled completely are forgotten once there are this many.
+MAX_BUCKETS = 1024
+
+def parse_limit(value):
+    """"count/seconds" to (burst, tokens per second), or None for no limit."""
+    value = value.strip()
+    if value in ("", "0"):
+        return None
+    try:
+        count, seconds = value.split("/")
+        count, seconds = int(count), float(seconds)
+    except ValueError:
+        raise ValueError("Not a count/seconds limit: {}".format(value))
+    if count <= 0 or seconds <= 0:
+        raise ValueError("Limits have to be positive: {}".format(value))
+    return (count, count / seconds)
+
+def parse_limits(value):
+    """"key=count/seconds, ..." to a dict."""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        if "=" not in item:
+            raise ValueError("Expected key=count/seconds: {}".format(item.strip()))
+        key, limit = item.split("=", 1)
+        limits[key.strip().lower()] = parse_limit(limit)
+    return limits
+
+def parse_levels(value):
+    try:
+        return {int(level): limit for level, limit in parse_limits(value).items()}
+    except ValueError as e:
+        raise ValueError("Levels have to be numbers: {}".format(e))
+
+SETTINGS = (
+    Setting("player_limit", "PlayerLimit", parse_limit, None),
+    Setting("command_limits", "CommandLimits", parse_limits, {}),
+    Setting("level_limits", "LevelLimits", parse_levels, {}),
+    Setting("network_limit", "NetworkLimit", parse_limit, None),
+    Setting("network_commands", "NetworkCommands", list, ()),
+    Setting("merge_commands", "MergeCommands", list, ()),
+    Setting("merge_window", "MergeWindow", float, 5.0),
+    )
+
+class TokenBucket():
+    __slots__ = ("capacity", "rate", "tokens", "stamp")
+
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+class RateLimiter():
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Keys: ("player", key), ("command", key, command) or ("network",) - Items: TokenBucket
+        self.buckets = {}
+        # Keys: (player key, command, args, channel) - Items: when it was last let through.
+        self.recent = {}
+        # Players we've told to slow down, until they get a command through again.
+        self.warned = set()
+        self.dropped = 0
+        self.merged = 0
+        # Whatever has the parsed [RateLimit] settings as its rate_limits attribute.
+        self.owner = None
+
+    def bucket(self, key, limit, now):
+        b = self.buckets.get(key)
+        if b is None or (b.capacity, b.rate) != limit:
+            # New, or the limit changed on a config reload.
+            b = self.buckets[key] = TokenBucket(limit[0], limit[1], now)
+        return b
+
+    def prune(self, now, merge_window):
+        for key in [k for k, b in self.buckets.items() if b.refill(now) >= b.capacity]:
+            del self.buckets[key]
+        for key in [k for k, t in self.recent.items() if now - t >= merge_window]:
+            del self.recent[key]
+
+    def allow(self, conf, names, player, level, args, channel):
+        """Returns True if the command can go through, "merged" if it's a repeat of one
+        that just did and False if it's over a limit. Only takes tokens if it goes through.
+
+        """
+        names = tuple(n.lower() for n in names)
+        key = playerkeys.key(player)
+        player_limit = conf.player_limit
+        levels = [lvl for lvl in conf.level_limits if level >= lvl]
+        if levels:
+            player_limit = conf.level_limits[max(levels)]
+            if player_limit is None:
+                # Trusted enough to not be limited at all.
+                return True
+
+        now = time.monotonic()
+        with self.lock:
+            request = None
+            if any(name in conf.merge_commands for name in names):
+                request = (key, names[0], tuple(a.lower() for a in args), getattr(channel, "name", None))
+                if request in self.recent and now - self.recent[request] < conf.merge_window:
+                    self.merged += 1
+                    return "merged"
+
+            needed = []
+            if player_limit:
+                needed.append(self.bucket(("player", key), player_limit, now))
+            for name in names:
+                if conf.command_limits.get(name):
+                    needed.append(self.bucket(("command", key, names[0]), conf.command_limits[name], now))
+                    break
+            if conf.network_limit and any(name in conf.network_commands for name in names):
+                needed.append(self.bucket(("network",), conf.network_limit, now))
+
+            if any(b.refill(now) < 1 for b in needed):
+                self.dropped += 1
+                return False
+            for b in needed:
+                b.tokens -= 1
+            if request:
+                self.recent[request] = now
+            self.warned.discard(key)
+
+            if len(self.buckets) + len(self.recent) > MAX_BUCKETS:
+                self.prune(now, conf.merge_window)
+            return True
+
+    def warn_once(self, player):
+        key = playerkeys.key(player)
+        with self.lock:
+            if key in self.warned:
+                return False
+            self.warned.add(key)
+            return True
+
+    def wrap(self, plugin, names, handler):
+        limiter = self
+        if isinstance(names, str):
+            names = (names,)
+
+        def limited(player, msg, channel):
+            conf = getattr(limiter.owner, "rate_limits", None)
+            # Commands from IRC and the console come from the bot itself.
+            if conf is None or player is None or isinstance(player, minqlbot.DummyPlayer):
+                return handler(player, msg, channel)
+
+            level = plugin.get_permission(player) or 0
+            allowed = limiter.allow(conf, names, player, level, msg[1:], channel)
+            if allowed is True:
+                return handler(player, msg, channel)
+            elif not limiter.warn_once(player):
+                return
+            elif allowed == "merged":
+                channel.reply("^7You just asked that, ^6{}^7. See the answer above.".format(player.clean_name))
+            else:
+                channel.reply("^7Slow down, ^6{}^7. Try again in a bit.".format(player.clean_name))
+        limited.__doc__ = handler.__doc__
+        limited.limited = handler
+        return limited
+
+_limiter = RateLimiter()
+_original = {}
+
+def get_limiter():
+    return _limiter
+
+def install(plugin_class, owner):
+    """Wrap add_command on plugin_class so every handler registered from now on is
+    limited, using the settings in owner.rate_limits.
+
+    """
+    _limiter.owner = owner
+    if _original:
+        return
+    original = plugin_class.add_command
+    def add_command(self, name, handler, *args, **kwargs):
+        return original(self, name, _limiter.wrap(self, name, handler), *args, **kwargs)
+    add_command.__doc__ = original.__doc__
+    plugin_class.add_command = add_command
+    _original["add_command"] = original
+    _original["class"] = plugin_class
+
+def uninstall():
+    if not _original:
+        return
+    _original["class"].add_command = _original["add_command"]
+    _original.clear()
+    _limiter.owner = None
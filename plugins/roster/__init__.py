@@ -0,0 +1,2 @@
+from plugins.roster.roster import Roster, get_roster, RECONCILE_INTERVAL
+from plugins.roster.nameindex import NameIndex
\ No newline at end of file
@@ -0,0 +1,73 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""A prefix trie over player keys for resolving partial names.
+
+Every node keeps the set of keys below it, so looking up a prefix is a walk of
+len(prefix) nodes and tells us right away whether the match is unique. With a few dozen
+players on a server the extra sets are nothing.
+"""
+
+class NameIndex():
+    def __init__(self):
+        # Nodes are [children, keys].
+        self.root = [{}, set()]
+
+    def add(self, key):
+        node = self.root
+        node[1].add(key)
+        for c in key:
+            node = node[0].setdefault(c, [{}, set()])
+            node[1].add(key)
+
+    def remove(self, key):
+        if key not in self.root[1]:
+            return
+        node = self.root
+        node[1].discard(key)
+        for c in key:
+            child = node[0][c]
+            child[1].discard(key)
+            if not child[1]:
+                # Nothing else goes through here, so the whole branch can go.
+                del node[0][c]
+                return
+            node = child
+
+    def clear(self):
+        self.root = [{}, set()]
+
+    def find(self, prefix):
+        """Keys starting with prefix. An exact match is returned alone, even if it's
+        also the prefix of other keys.
+
+        """
+        node = self.root
+        for c in prefix:
+            if c not in node[0]:
+                return set()
+            node = node[0][c]
+        if prefix in node[1]:
+            return {prefix}
+        return set(node[1])
+
+    def __contains__(self, key):
+        return key in self.root[1]
+
+    def __len__(self):
+        return len(self.root[1])
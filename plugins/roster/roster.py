@@ -0,0 +1,165 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Who's on which team, kept up to date from events.
+
+Plugin.teams() builds the team lists from scratch every time it's called, and some
+hooks call it on every connect, disconnect and team switch. The roster instead
+follows player_connect, player_disconnect and team_switch as they come in, so team
+counts are just a len() and snapshots only get rebuilt after something changed. In
+case we miss an event, it's reconciled against teams() every so often and whenever
+we connect to a server. It also keeps a prefix index of the names, so commands can
+resolve partial names without going through every player.
+
+plugin_manager installs the hooks at the highest priority, so every other plugin
+already sees the roster with the event applied.
+"""
+
+import threading
+import types
+
+import minqlbot
+import plugins.playerkeys as playerkeys
+import plugins.scheduler as scheduler
+
+from plugins.roster.nameindex import NameIndex
+
+RECONCILE_INTERVAL = 60
+TEAMS = ("default", "red", "blue", "spectator")
+
+class Roster():
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Keys: team - Items: {player key: Player}
+        self.members = {team: {} for team in TEAMS}
+        # Keys: player key - Items: team
+        self.team_of = {}
+        self.names = NameIndex()
+        self.cached_snapshot = None
+        self.reconcile_timer = None
+        self.plugin = None
+
+    def install(self, plugin):
+        """Follow events through plugin's hooks and start reconciling periodically."""
+        self.plugin = plugin
+        plugin.add_hook("player_connect", self.handle_player_connect, minqlbot.PRI_HIGHEST)
+        plugin.add_hook("player_disconnect", self.handle_player_disconnect, minqlbot.PRI_HIGHEST)
+        plugin.add_hook("team_switch", self.handle_team_switch, minqlbot.PRI_HIGHEST)
+        plugin.add_hook("bot_connect", self.handle_bot_connect, minqlbot.PRI_HIGHEST)
+        self.reconcile_timer = scheduler.schedule(0, self.reconcile_periodically)
+
+    def uninstall(self):
+        self.plugin = None
+        if self.reconcile_timer:
+            self.reconcile_timer.cancel()
+
+    def handle_player_connect(self, player):
+        self.set_team(player, getattr(player, "team", None) or "spectator")
+
+    def handle_player_disconnect(self, player, reason):
+        with self.lock:
+            key = playerkeys.key(player)
+            if key in self.team_of:
+                del self.members[self.team_of.pop(key)][key]
+                self.names.remove(key)
+                self.cached_snapshot = None
+
+    def handle_team_switch(self, player, old_team, new_team):
+        self.set_team(player, new_team)
+
+    def handle_bot_connect(self):
+        self.reconcile()
+
+    def set_team(self, player, team):
+        with self.lock:
+            key = playerkeys.key(player)
+            if key in self.team_of:
+                del self.members[self.team_of[key]][key]
+            self.members.setdefault(team, {})[key] = player
+            self.team_of[key] = team
+            self.names.add(key)
+            self.cached_snapshot = None
+
+    def reconcile(self):
+        """Replace the roster with what the server says. Returns whether it was off."""
+        if not self.plugin:
+            return False
+        teams = self.plugin.teams()
+        members = {team: {} for team in TEAMS}
+        team_of = {}
+        # There's no event for name changes, so this is also where those get picked up.
+        names = NameIndex()
+        for team in teams:
+            for player in teams[team]:
+                key = playerkeys.key(player)
+                members.setdefault(team, {})[key] = player
+                team_of[key] = team
+                names.add(key)
+
+        with self.lock:
+            drifted = team_of != self.team_of
+            self.members = members
+            self.team_of = team_of
+            self.names = names
+            self.cached_snapshot = None
+        return drifted
+
+    def reconcile_periodically(self):
+        try:
+            if self.reconcile():
+                self.plugin.debug("The roster had drifted from the server and was reconciled.")
+        finally:
+            if self.plugin:
+                self.reconcile_timer = scheduler.schedule(RECONCILE_INTERVAL, self.reconcile_periodically)
+
+    def count(self, *teams):
+        """Number of players on the given teams, or on any team if none are given."""
+        with self.lock:
+            if not teams:
+                return len(self.team_of)
+            return sum(len(self.members.get(team, ())) for team in teams)
+
+    def team(self, player):
+        """The team of a Player or a name, or None if they're not on the server."""
+        with self.lock:
+            return self.team_of.get(playerkeys.key(player))
+
+    def find(self, name):
+        """Players whose name starts with name, ignoring colors and case. More than one
+        means it's ambiguous, unless one of them is an exact match, which wins.
+
+        """
+        with self.lock:
+            keys = self.names.find(playerkeys.key(name))
+            return [self.members[self.team_of[key]][key] for key in sorted(keys)]
+
+    def snapshot(self):
+        """An immutable view in the same format as Plugin.teams(), but with tuples.
+        Cheap to call repeatedly, since it's only rebuilt after the roster changes.
+
+        """
+        with self.lock:
+            if self.cached_snapshot is None:
+                self.cached_snapshot = types.MappingProxyType(
+                    {team: tuple(self.members[team].values()) for team in self.members})
+            return self.cached_snapshot
+
+_roster = Roster()
+
+def get_roster():
+    return _roster
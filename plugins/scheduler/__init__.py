@@ -0,0 +1 @@
+from plugins.scheduler.scheduler import Scheduler, Timer, get_scheduler, schedule, cancel, stop_scheduler
\ No newline at end of file
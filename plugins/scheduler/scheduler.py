@@ -0,0 +1,210 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""One thread for all of the plugins' deferred work.
+
+Plugin.delay starts a new timer thread for every call, so a burst of connects means a
+burst of threads that mostly just sleep. Here everything goes on a heap that a single
+thread works through. Timers can be cancelled, and scheduling with a key that already
+has a timer waiting coalesces into that one instead of adding another, so telling the
+same player the same thing twice or queuing two auto-balances can't happen.
+
+Callbacks run on the scheduler thread one after the other, so they should be quick.
+Anything that can take a while, like waiting on the database, should pass thread=True
+to get a thread of its own when it fires.
+
+    timer = scheduler.schedule(15, self.tell_motd, args=(player, motd), key=("motd", name))
+    timer.cancel()
+
+Plugins should cancel their timers when they're unloaded. Keyed ones can be cancelled
+all at once with scheduler.cancel("motd"), which also gets every ("motd", ...) key.
+"""
+
+import itertools
+import threading
+import traceback
+import heapq
+import time
+
+class Timer():
+    """Returned by schedule(). Has the same cancel() and is_alive() as the timers
+    Plugin.delay returns, so it can be used in their place.
+
+    """
+    __slots__ = ("when", "func", "args", "kwargs", "key", "thread", "cancelled", "done", "scheduler")
+
+    def __init__(self, scheduler, when, func, args, kwargs, key, thread):
+        self.scheduler = scheduler
+        self.when = when
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.thread = thread
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def is_alive(self):
+        return not self.cancelled and not self.done
+
+class Scheduler(threading.Thread):
+    def __init__(self):
+        super().__init__(name="scheduler", daemon=True)
+        self.condition = threading.Condition()
+        # Items: (when, sequence, Timer). The sequence keeps equal times in order.
+        self.heap = []
+        self.sequence = itertools.count()
+        # Keys: coalescing key - Items: the Timer waiting for it.
+        self.keyed = {}
+        # Timers still on the heap that were cancelled, removed lazily.
+        self.cancelled = 0
+        self.running = True
+        self.fired = 0
+        self.coalesced = 0
+
+    def schedule(self, delay, func, args=(), kwargs=None, key=None, thread=False):
+        with self.condition:
+            if key is not None and key in self.keyed:
+                self.coalesced += 1
+                return self.keyed[key]
+
+            timer = Timer(self, time.monotonic() + delay, func, args, kwargs or {}, key, thread)
+            heapq.heappush(self.heap, (timer.when, next(self.sequence), timer))
+            if key is not None:
+                self.keyed[key] = timer
+            # Only wake up if this is the new earliest one.
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+            return timer
+
+    def cancel(self, timer):
+        with self.condition:
+            if not timer.is_alive():
+                return
+            timer.cancelled = True
+            if timer.key is not None and self.keyed.get(timer.key) is timer:
+                del self.keyed[timer.key]
+            self.cancelled += 1
+            # Don't let a pile of cancelled timers sit on the heap.
+            if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def cancel_key(self, key):
+        """Cancel the timer waiting for key, and those of tuple keys starting with it."""
+        with self.condition:
+            timers = [timer for k, timer in self.keyed.items()
+                      if k == key or (isinstance(k, tuple) and k and k[0] == key)]
+        for timer in timers:
+            self.cancel(timer)
+        return len(timers)
+
+    def pending(self):
+        with self.condition:
+            return len(self.heap) - self.cancelled
+
+    def next_due(self):
+        """Seconds until the next timer fires, or None if there are none."""
+        with self.condition:
+            live = [when for when, seq, timer in self.heap if not timer.cancelled]
+        if not live:
+            return None
+        return max(0, min(live) - time.monotonic())
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    when, seq, timer = self.heap[0]
+                    if timer.cancelled:
+                        heapq.heappop(self.heap)
+                        self.cancelled -= 1
+                        continue
+                    now = time.monotonic()
+                    if when > now:
+                        self.condition.wait(when - now)
+                        continue
+                    heapq.heappop(self.heap)
+                    timer.done = True
+                    if timer.key is not None and self.keyed.get(timer.key) is timer:
+                        del self.keyed[timer.key]
+                    self.fired += 1
+                    break
+                else:
+                    return
+
+            if timer.thread:
+                threading.Thread(target=self.fire, args=(timer,)).start()
+            else:
+                self.fire(timer)
+
+    def fire(self, timer):
+        try:
+            timer.func(*timer.args, **timer.kwargs)
+        except:
+            import minqlbot
+            e = traceback.format_exc().rstrip("\n")
+            minqlbot.debug("========== ERROR: {}@scheduler ==========".format(getattr(timer.func, "__qualname__", timer.func)))
+            for line in e.split("\n"):
+                minqlbot.debug(line)
+
+_scheduler = None
+_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+    with _lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = Scheduler()
+            _scheduler.start()
+        return _scheduler
+
+def schedule(delay, func, args=(), kwargs=None, key=None, thread=False):
+    """Call func(*args, **kwargs) in delay seconds. Returns a Timer."""
+    return get_scheduler().schedule(delay, func, args, kwargs, key, thread)
+
+def cancel(key):
+    """Cancel the timer waiting for key, and those of tuple keys starting with it.
+    Returns how many were cancelled.
+
+    """
+    with _lock:
+        scheduler = _scheduler
+    # Don't start a scheduler just to find it has nothing to cancel.
+    if scheduler is None:
+        return 0
+    return scheduler.cancel_key(key)
+
+def stop_scheduler():
+    global _scheduler
+    with _lock:
+        if _scheduler is not None:
+            _scheduler.stop()
+            _scheduler = None
@@ -20,6 +20,9 @@
 
 import minqlbot
 
+import plugins.playerkeys as playerkeys
+import plugins.roster as roster
+
 class serverratings(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
@@ -30,31 +33,22 @@ class serverratings(minqlbot.Plugin):
         if "balance" not in self.plugins:
             return
 
-        teams = self.teams()
+        teams = roster.get_roster().snapshot()
         teams = teams["red"] + teams["blue"]
         self.print_ratings(teams, channel, self.game().short_type)
 
     def print_ratings(self, names, channel, game_type):
         balance = self.plugins["balance"]
 
-        not_cached = balance.not_cached(game_type, names)
-        if not_cached:
-            with balance.rlock:
-                for lookup in balance.lookups:
-                    for n in balance.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    balance.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.print_ratings, (names, channel, game_type)) not in balance.pending:
-                    balance.pending.append((self.print_ratings, (names, channel, game_type)))
-                return False
-
-        teams = self.teams()
-        red_sorted = sorted(teams["red"], key=lambda x: balance.cache[x.clean_name.lower()][game_type]["elo"], reverse=True)
-        blue_sorted = sorted(teams["blue"], key=lambda x: balance.cache[x.clean_name.lower()][game_type]["elo"], reverse=True)
-        red = "^7" + ", ".join(["{}: ^1{}^7".format(p, balance.cache[p.clean_name.lower()][game_type]["elo"]) for p in red_sorted])
-        blue = "^7" + ", ".join(["{}: ^4{}^7".format(p, balance.cache[p.clean_name.lower()][game_type]["elo"]) for p in blue_sorted])
+        if not balance.wait_for_ratings(self.print_ratings, (names, channel, game_type), names, channel, game_type):
+            return False
+
+        rating = lambda p: balance.get_rating(playerkeys.key(p), game_type)
+        teams = roster.get_roster().snapshot()
+        red_sorted = sorted(teams["red"], key=rating, reverse=True)
+        blue_sorted = sorted(teams["blue"], key=rating, reverse=True)
+        red = "^7" + ", ".join(["{}: ^1{}^7".format(p, rating(p)) for p in red_sorted])
+        blue = "^7" + ", ".join(["{}: ^4{}^7".format(p, rating(p)) for p in blue_sorted])
 
         channel.reply(red)
         channel.reply(blue)
@@ -0,0 +1 @@
+from plugins.settings.settings import Setting, register, unregister, reload, compile_section
\ No newline at end of file
@@ -0,0 +1,119 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Typed, pre-parsed config snapshots for plugins.
+
+A plugin declares the keys it reads from its config section once, with a type and a
+default, and registers them. It then gets an immutable snapshot with the values already
+parsed as an attribute, so hooks just read self.settings.floor_rating instead of
+looking up and parsing strings every time. When the config is reloaded, every snapshot
+is rebuilt first and then swapped in, and values that don't parse are reported right
+away and replaced by their default.
+
+    SETTINGS = (Setting("floor_rating", "FloorRating", int, 0), ...)
+
+    def __init__(self):
+        settings.register(self, "Balance", SETTINGS)
+"""
+
+from collections import namedtuple
+import configparser
+import threading
+
+class Setting(namedtuple("Setting", ("name", "key", "type", "default"))):
+    """name is the snapshot attribute, key the config key. type is int, float, bool, str
+    or list, the latter being a comma separated list of strings. A default of None
+    means the setting is optional and None when it's not in the config.
+
+    """
+    def parse(self, value):
+        if self.type is bool:
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError("Not a boolean: {}".format(value))
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        elif self.type is list:
+            return tuple(s.strip() for s in value.split(",") if s.strip())
+        return self.type(value.strip())
+
+_snapshot_types = {}
+_registered = {}
+_lock = threading.RLock()
+
+def compile_section(config, section, schema):
+    """Parse a config section according to a schema. Returns (snapshot, errors)."""
+    fields = tuple(s.name for s in schema)
+    with _lock:
+        if fields not in _snapshot_types:
+            _snapshot_types[fields] = namedtuple("Settings", fields)
+        snapshot_type = _snapshot_types[fields]
+
+    values = []
+    errors = []
+    has_section = config is not None and section in config
+    for setting in schema:
+        if has_section and setting.key in config[section]:
+            try:
+                values.append(setting.parse(config[section][setting.key]))
+            except ValueError as e:
+                errors.append("[{}] {}: {}".format(section, setting.key, e))
+                values.append(setting.default)
+        else:
+            values.append(setting.default)
+    return snapshot_type(*values), errors
+
+def register(plugin, section, schema, attribute="settings", config=None, on_reload=None):
+    """Give plugin a snapshot of a config section as the given attribute, and keep it
+    up to date on reloads. on_reload, if given, is called after every reload, for values
+    that get copied somewhere else. Returns the parsing errors, if any.
+
+    """
+    if config is None:
+        import minqlbot
+        config = minqlbot.get_config()
+    snapshot, errors = compile_section(config, section, schema)
+    setattr(plugin, attribute, snapshot)
+    with _lock:
+        # Keyed by class name, so a reloaded plugin replaces its old instance.
+        _registered[(plugin.__class__.__name__, attribute)] = (plugin, section, schema, on_reload)
+    for error in errors:
+        plugin.debug("Invalid config value: {}".format(error))
+    return errors
+
+def unregister(plugin):
+    with _lock:
+        for key in [k for k, v in _registered.items() if v[0] is plugin]:
+            del _registered[key]
+
+def reload(config):
+    """Rebuild every registered snapshot from config. Nothing is swapped in until all of
+    them have been built. Returns a list of errors.
+
+    """
+    with _lock:
+        built = []
+        errors = []
+        for (name, attribute), (plugin, section, schema, on_reload) in _registered.items():
+            snapshot, section_errors = compile_section(config, section, schema)
+            built.append((plugin, attribute, snapshot, on_reload))
+            errors.extend(section_errors)
+        for plugin, attribute, snapshot, on_reload in built:
+            setattr(plugin, attribute, snapshot)
+        for plugin, attribute, snapshot, on_reload in built:
+            if on_reload:
+                on_reload()
+        return errors
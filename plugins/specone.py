@@ -21,13 +21,15 @@
 import minqlbot
 import random
 
+import plugins.roster as roster
+
 class specone(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
         self.add_command(("onespec", "specone", "gospec"), self.cmd_onespec, 1)
             
     def cmd_onespec(self, player, msg, channel):
-        allteams = self.teams()
+        allteams = roster.get_roster().snapshot()
         teams = allteams["red"] + allteams["blue"]
         
         try:
@@ -37,9 +39,11 @@ class specone(minqlbot.Plugin):
             return        
         self.put(chosen.clean_name, "spectator")
         
-        allteams = self.teams()
-        if (len(allteams["red"]) == len(allteams["blue"]) and (len(allteams["red"]) > 1)):
-            new_ts = len(allteams["red"])
+        # The switch hasn't come through yet, so work out the teams as they'll be.
+        red = len(allteams["red"]) - (chosen in allteams["red"])
+        blue = len(allteams["blue"]) - (chosen in allteams["blue"])
+        if (red == blue and (red > 1)):
+            new_ts = red
             self.teamsize(new_ts)
             channel.reply("^7Teamsize was set to ^6{}^7.".format(new_ts))
             
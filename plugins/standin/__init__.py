@@ -0,0 +1 @@
+from plugins.standin.standin import StandInServer, serve
\ No newline at end of file
@@ -0,0 +1,149 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) WalkerY
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for QLRanks and the Quake Live profile pages.
+
+Serves recorded responses from the fixtures folder so the fetch paths can be tested
+and load-tested without touching the live sites. Point the bot at it with:
+
+    [Balance]
+    QlRanksUrl: http://localhost:8080/
+    [Ban]
+    QlProfileUrl: http://localhost:8080/
+
+QLRanks requests go to /api.aspx?nick=a+b+c. Nicks without a fixture in fixtures/qlranks
+get QLRanks' "no data" answer. Profile requests go to /profile/summary/<name>, and fall
+back to fixtures/profile/default.html with the name filled in.
+
+Run it with: python -m plugins.standin.standin [--port 8080] [--latency 0.5]
+[--error-rate 0.1] [--timeout-rate 0.05]
+"""
+
+import http.server
+import socketserver
+import urllib.parse
+import threading
+import random
+import json
+import time
+import sys
+import os
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+QLRANKS_GAMETYPES = ("ca", "ffa", "ctf", "duel", "tdm")
+# How long a "timed out" request hangs. Longer than the 10 seconds QlRanks waits.
+HANG_TIME = 30
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+        roll = random.random()
+        if roll < server.timeout_rate:
+            time.sleep(HANG_TIME)
+            return
+        elif roll < server.timeout_rate + server.error_rate:
+            self.respond(503, "text/plain", b"Service Unavailable")
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.endswith("/api.aspx"):
+            query = urllib.parse.parse_qs(url.query)
+            nicks = query.get("nick", [""])[0].replace(" ", "+").split("+")
+            data = {"players": [qlranks_player(nick) for nick in nicks if nick]}
+            self.respond(200, "application/json", json.dumps(data).encode())
+        elif "/profile/summary/" in url.path:
+            name = url.path.rsplit("/", 1)[-1]
+            self.respond(200, "text/html; charset=utf-8", profile_page(name))
+        else:
+            self.respond(404, "text/plain", b"Not Found")
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("localhost", 8080), latency=0, error_rate=0, timeout_rate=0, verbose=False):
+        http.server.HTTPServer.__init__(self, address, StandInHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.verbose = verbose
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return "http://{}:{}/".format(*self.server_address[:2])
+
+def qlranks_player(nick):
+    path = os.path.join(FIXTURES, "qlranks", os.path.basename(nick.lower()) + ".json")
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    # What QLRanks answers for players it knows nothing about.
+    player = {"nick": nick}
+    for game_type in QLRANKS_GAMETYPES:
+        player[game_type] = {"elo": 1200, "rank": 0}
+    return player
+
+def profile_page(name):
+    path = os.path.join(FIXTURES, "profile", os.path.basename(name.lower()) + ".html")
+    if not os.path.isfile(path):
+        path = os.path.join(FIXTURES, "profile", "default.html")
+    with open(path, "rb") as f:
+        return f.read().replace(b"{name}", name.encode())
+
+def serve(port=8080, **kwargs):
+    """Start a stand-in server on a background thread and return it.
+    Call shutdown() on it when done.
+
+    """
+    server = StandInServer(("localhost", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {"port": 8080, "latency": 0.0, "error-rate": 0.0, "timeout-rate": 0.0}
+    for i in range(0, len(args) - 1, 2):
+        key = args[i].lstrip("-")
+        if key in options:
+            options[key] = type(options[key])(args[i + 1])
+
+    server = StandInServer(("localhost", options["port"]), latency=options["latency"],
+                           error_rate=options["error-rate"], timeout_rate=options["timeout-rate"],
+                           verbose=True)
+    print("Serving QLRanks and Quake Live profiles on {}".format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()